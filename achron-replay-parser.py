@@ -1,8 +1,35 @@
 #!/usr/bin/env python
 
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import csv
+import gc
+import glob
+import hashlib
+import io
+import itertools
+import json
+import marshal
+import mmap
+import multiprocessing
+import os
+import pickle
+import sqlite3
 import struct
+import sys
+import tempfile
+import time
+import zlib
 from optparse import OptionParser
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -11,6 +38,23 @@ def enum(*sequential, **named):
     return type('Enum', (), enums)
 
 
+def _require_numpy(feature):
+    if numpy is None:
+        raise ImportError("%s requires numpy" % feature)
+
+
+def _require_importable(feature, function):
+    # Worker processes find functions by module name, which fails if this
+    # file was loaded with importlib without registering it in sys.modules.
+    module = sys.modules.get(function.__module__)
+    if getattr(module, function.__name__, None) is not function:
+        raise RuntimeError(
+            "%s runs %s in other processes, which requires this module to be "
+            "registered in sys.modules as %r (see load_parser in "
+            "benchmarks/common.py)" % (feature, function.__name__,
+                                        function.__module__))
+
+
 def _unpack_bitmask(value, length):
     return [bool(value & (1 << x)) for x in range(length - 1)]
 
@@ -23,15 +67,31 @@ def _read_length_prefixed_field(len_type, data, offset=0):
 
 def _read_string(len_type, data, offset=0):
     data, offset = _read_length_prefixed_field(len_type, data, offset)
-    return data.decode('ascii'), offset
+    return str(data, 'ascii'), offset
+
+# Bump whenever the decoded form of messages changes, to invalidate
+# ReplayCache entries.
+PARSER_VERSION = 2
 
 GAME_TICKS_PER_SECOND = 18
 
 
+# Formatted timestamps by tick, as most messages share a timestamp with
+# others; cleared when it grows too large.
+_formatted_timestamps = {}
+_formatted_timestamps_limit = 1 << 16
+
+
 def format_timestamp(ticks):
-    minutes, ticks = divmod(ticks, GAME_TICKS_PER_SECOND * 60)
-    seconds, ticks = divmod(ticks, GAME_TICKS_PER_SECOND)
-    return "%3dm %2ds %2dt" % (minutes, seconds, ticks)
+    text = _formatted_timestamps.get(ticks)
+    if text is None:
+        if len(_formatted_timestamps) >= _formatted_timestamps_limit:
+            _formatted_timestamps.clear()
+        minutes, rest = divmod(ticks, GAME_TICKS_PER_SECOND * 60)
+        seconds, rest = divmod(rest, GAME_TICKS_PER_SECOND)
+        text = _formatted_timestamps[ticks] = "%3dm %2ds %2dt" % (
+            minutes, seconds, rest)
+    return text
 
 MessageType = enum(
     "NO_MESSAGE",
@@ -79,6 +139,9 @@ CommandType = enum(
 
 
 class Player(object):
+    __slots__ = ('seat', 'name', 'time_position', '_last_timestamp',
+                 '_time_speed_factor', '_text')
+
     def __init__(self, seat, name):
         self.seat = seat
         self.name = name
@@ -91,15 +154,60 @@ class Player(object):
         self.time_position += int(delta_game_ticks * self._time_speed_factor)
         self._last_timestamp = timestamp
 
+    def _get_state(self):
+        return [self.seat, self.name, self.time_position, self._last_timestamp,
+                self._time_speed_factor]
+
+    @classmethod
+    def _from_state(cls, state):
+        seat, name, time_position, last_timestamp, time_speed_factor = state
+        player = cls(seat, name)
+        player.time_position = time_position
+        player._last_timestamp = last_timestamp
+        player._time_speed_factor = time_speed_factor
+        return player
+
     def __str__(self):
-        return "%s (player %d)" % (self.name, self.seat)
+        # Every message of the player formats it, so only do so once.
+        try:
+            return self._text
+        except AttributeError:
+            self._text = text = "%s (player %d)" % (self.name, self.seat)
+            return text
 
 # Seems to be the player number for non-player-specific messages.
 NONE_PLAYER = 255
 
 class BaseReplayMessage(object):
-    """Parent class of all replay messages."""
-    def __init__(self, timestamp, message, player, data):
+    """Parent class of all replay messages.
+
+    Construction is split in two: _decode sets the attributes that only
+    depend on the payload, and _attach applies the message to the player's
+    state. With lazy set, _decode is deferred until one of its attributes is
+    first accessed; the message then keeps a view of its payload until then.
+
+    Messages use __slots__ throughout the hierarchy to keep them small, so
+    subclasses have to declare __slots__ for the attributes they set.
+    """
+    __slots__ = ('timestamp', 'player', '_payload')
+
+    # Whether constructing the message changes state other than the player's
+    # timestamp, so it must be constructed even if nobody asked for it.
+    _stateful = False
+    # Whether the message advances the timestamp of the player it belongs to.
+    _updates_timestamp = True
+
+    def __init__(self, timestamp, message, player, data, lazy=False):
+        if lazy:
+            self._payload = data
+        else:
+            self._decode(data)
+        self._attach(timestamp, player)
+
+    def _decode(self, data):
+        pass
+
+    def _attach(self, timestamp, player):
         self.timestamp = timestamp
         if player == NONE_PLAYER:
             self.player = None
@@ -107,14 +215,33 @@ class BaseReplayMessage(object):
             player._update_timestamp(timestamp)
             self.player = player
 
+    def __getattr__(self, name):
+        # Only called for unset attributes, i.e. ones that a deferred _decode
+        # has not set yet.
+        if name == '_payload':
+            raise AttributeError(name)
+        try:
+            payload = self._payload
+        except AttributeError:
+            raise AttributeError("%r object has no attribute %r"
+                                 % (type(self).__name__, name))
+        # Keep the payload until it decodes, so that every access to a field
+        # of a corrupt payload raises the decoding error.
+        self._decode(payload)
+        del self._payload
+        return getattr(self, name)
+
 
 class NetworkMessage(BaseReplayMessage):
     """Parent class of all network-related replay messages."""
-    pass
+    __slots__ = ()
 
 
 class NoOpMessage(NetworkMessage):
-    def __init__(self, timestamp, message, player, data):
+    __slots__ = ()
+    _updates_timestamp = False
+
+    def _attach(self, timestamp, player):
         self.timestamp = timestamp
 
     def __str__(self):
@@ -122,12 +249,15 @@ class NoOpMessage(NetworkMessage):
 
 
 class NewClientMessage(NetworkMessage):
-    def __init__(self, timestamp, message, player, data):
+    __slots__ = ()
+    _stateful = True
+
+    def __init__(self, timestamp, message, player, data, lazy=False):
         # Edited replays will contain joins by the observer (who may have been
         # a participant in the replay), so player may already be an instance
         # of Player.
         if not isinstance(player, Player):
-            player = Player(player, data.decode('ascii'))
+            player = Player(player, str(data, 'ascii'))
         super(NewClientMessage, self).__init__(timestamp, message, player, data)
 
     def __str__(self):
@@ -135,8 +265,14 @@ class NewClientMessage(NetworkMessage):
 
 
 class NewBannedClientMessage(NetworkMessage):
-    def __init__(self, timestamp, message, player, data):
-        self.player = player = Player(player, data.decode('ascii'))
+    __slots__ = ()
+    # The banned client gets a Player of its own, not the one in the seat.
+    _updates_timestamp = False
+
+    def __init__(self, timestamp, message, player, data, lazy=False):
+        if isinstance(player, Player):
+            player = player.seat
+        self.player = player = Player(player, str(data, 'ascii'))
         super(NewBannedClientMessage, self).__init__(timestamp, message, player, data)
 
     def __str__(self):
@@ -144,28 +280,90 @@ class NewBannedClientMessage(NetworkMessage):
 
 
 class DisconnectedMessage(NetworkMessage):
+    __slots__ = ()
+    _stateful = True
+
     def __str__(self):
         return "%s disconnects" % self.player
 
 
 class ErrorMessage(NetworkMessage):
+    __slots__ = ()
+
     def __str__(self):
         return "An error occurred"
 
 
+class UnknownMessage(BaseReplayMessage):
+    """A record that could not be decoded, yielded in tolerant mode (see
+    Replay.messages) with its header fields and payload bytes. It does not
+    change any player's state."""
+    __slots__ = ('msg_type', 'message', 'data')
+
+    def __init__(self, timestamp, msg_type, message, player, data):
+        self.msg_type = msg_type
+        self.message = message
+        self.data = bytes(data)
+        self._attach(timestamp, player)
+
+    def _attach(self, timestamp, player):
+        self.timestamp = timestamp
+        self.player = player if isinstance(player, Player) else None
+
+    def __str__(self):
+        return "Undecodable message (type %d, content %d, %d bytes)" % (
+            self.msg_type, self.message, len(self.data))
+
+
+class RecordError(object):
+    """A problem found while parsing a replay in tolerant mode.
+
+    kind is 'decode' for a record that could not be decoded, which is yielded
+    as an UnknownMessage, or 'framing' for bytes at offset that do not form
+    records and were skipped. The header fields are those of the record, and
+    size is its payload size or the number of bytes skipped.
+    """
+
+    def __init__(self, kind, description, offset=None, timestamp=None,
+                 msg_type=None, message=None, seat=None, size=None):
+        self.kind = kind
+        self.description = description
+        self.offset = offset
+        self.timestamp = timestamp
+        self.msg_type = msg_type
+        self.message = message
+        self.seat = seat
+        self.size = size
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in (
+            'kind', 'description', 'offset', 'timestamp', 'msg_type',
+            'message', 'seat', 'size'))
+
+    def __str__(self):
+        if self.kind == 'framing':
+            return "skipped %d bytes at offset %d: %s" % (
+                self.size, self.offset, self.description)
+        return "undecodable record at %s (type %s, content %s, seat %s): %s" % (
+            format_timestamp(self.timestamp).strip(), self.msg_type,
+            self.message, self.seat, self.description)
+
+
 class GameMessage(BaseReplayMessage):
     """Parent class of all game-related replay messages."""
+    __slots__ = ()
 
 
 class ChatMessage(GameMessage):
-    pass
+    __slots__ = ()
 
 
 class PrivateChatMessage(ChatMessage):
-    def __init__(self, timestamp, message, player, data):
-        super(PrivateChatMessage, self).__init__(timestamp, message, player, data)
+    __slots__ = ('recipient', 'contents')
+
+    def _decode(self, data):
         self.recipient = struct.unpack_from("<B", data)
-        self.contents = data[1:].decode('ascii').strip()
+        self.contents = str(data[1:], 'ascii').strip()
 
     def __str__(self):
         return "%s whispers to %s: %s" % (self.player, self.recipient,
@@ -173,37 +371,47 @@ class PrivateChatMessage(ChatMessage):
 
 
 class PublicChatMessage(ChatMessage):
-    def __init__(self, timestamp, message, player, data):
-        super(PublicChatMessage, self).__init__(timestamp, message, player, data)
-        self.contents = data.decode('ascii').strip()
+    __slots__ = ('contents',)
+
+    def _decode(self, data):
+        self.contents = str(data, 'ascii').strip()
 
     def __str__(self):
         return "%s says: %s" % (self.player, self.contents)
 
 
 class UnpauseEngine(GameMessage):
+    __slots__ = ()
+
     def __str__(self):
         return "%s unpauses the game" % self.player
 
 
 class PauseEngine(GameMessage):
+    __slots__ = ()
+
     def __str__(self):
         return "%s pauses the game" % self.player
 
 
 class SaveGame(GameMessage):
+    __slots__ = ()
+
     def __str__(self):
         return "%s saves the game" % self.player
 
 
 class PlayerSurrender(GameMessage):
+    __slots__ = ()
+
     def __str__(self):
         return "%s surrenders" % self.player
 
 
 class GlobalTimeRateChange(GameMessage):
-    def __init__(self, timestamp, message, player, data):
-        super(GlobalTimeRateChange, self).__init__(timestamp, message, player, data)
+    __slots__ = ('rate',)
+
+    def _decode(self, data):
         self.rate, = struct.unpack("<f", data)
 
     def __str__(self):
@@ -213,13 +421,41 @@ class GlobalTimeRateChange(GameMessage):
 # Commands
 
 class BaseCommand(GameMessage):
+    """Parent class of all commands in a CHRONAL_COMMANDS message.
+
+    command_type is the CommandType the command was decoded from, and
+    time_position the player's time position when the command was given
+    (for MoveTimePosition, the position jumped from).
+    """
+    __slots__ = ('command_type', 'time_position')
     _data_struct = struct.Struct("<")
 
+    def _attach(self, timestamp, player):
+        super(BaseCommand, self)._attach(timestamp, player)
+        self.time_position = (None if self.player is None
+                              else self.player.time_position)
+
+    @classmethod
+    def _decode_at(cls, timestamp, message, player, data, offset, lazy=False):
+        """Decode a command whose data starts at offset in data.
+
+        Returns the command and the number of bytes of data it consumed.
+        """
+        size = cls._data_struct.size
+        return cls(timestamp, message, player, data[offset:offset + size],
+                   lazy), size
+
 
 class MoveTimePosition(BaseCommand):
-    def __init__(self, timestamp, message, player, data):
-        super(MoveTimePosition, self).__init__(timestamp, message, player, data)
-        self.target_time, = struct.unpack("<I", data)
+    __slots__ = ('target_time',)
+    _data_struct = struct.Struct("<I")
+    _stateful = True
+
+    def _decode(self, data):
+        self.target_time, = MoveTimePosition._data_struct.unpack(data)
+
+    def _attach(self, timestamp, player):
+        super(MoveTimePosition, self)._attach(timestamp, player)
         player.time_position = self.target_time
 
     def __str__(self):
@@ -236,20 +472,29 @@ def _lower_bitmask(n):
     return bitmask
 
 
-def _get_objective(number, parameter=None):
-    candidates = objectives[number]
+# The names an objective number may stand for, split by whether the objective
+# takes a parameter: {number: (without parameter, with parameter)}.
+_objective_names = dict(
+    (number, (tuple(c[0] for c in candidates if c[1] == 'NO_PARAMETER'),
+              tuple(c[0] for c in candidates if c[1] != 'NO_PARAMETER')))
+    for number, candidates in objectives.items())
+
+
+# The same as comma-separated strings, for __str__.
+_objective_strings = dict(
+    (number, tuple(", ".join(names) for names in split))
+    for number, split in _objective_names.items())
 
-    if parameter is None:
-        return [c[0] for c in candidates if c[1] == 'NO_PARAMETER']
-    else:
-        return [c[0] for c in candidates if c[1] != 'NO_PARAMETER']
+
+def _get_objective(number, parameter=None):
+    return _objective_names[number][parameter is not None]
 
 
 class AssignUnitObjective(BaseCommand):
+    __slots__ = ('unit', 'objective', 'parameter', 'queued')
     _data_struct = struct.Struct("<HBI")
 
-    def __init__(self, timestamp, message, player, data):
-        super(AssignUnitObjective, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.unit, objective, self.parameter = AssignUnitObjective._data_struct.unpack_from(data)
         self.objective = objective & _lower_bitmask(6)
         self.queued = bool(objective & (1 << 7))
@@ -260,14 +505,14 @@ class AssignUnitObjective(BaseCommand):
             method = "queued"
 
         return "%s %s unit %d objective %d (one of %s)" % (self.player, method,
-            self.unit, self.objective, ', '.join(_get_objective(self.objective, self.parameter)))
+            self.unit, self.objective, _objective_strings[self.objective][self.parameter is not None])
 
 
 class AssignUnitObjectiveOnly(BaseCommand):
+    __slots__ = ('unit', 'objective', 'queued')
     _data_struct = struct.Struct("<HB")
 
-    def __init__(self, timestamp, message, player, data):
-        super(AssignUnitObjectiveOnly, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.unit, objective = AssignUnitObjectiveOnly._data_struct.unpack_from(data)
         self.objective = objective & _lower_bitmask(6)
         self.queued = bool(objective & (1 << 7))
@@ -278,14 +523,14 @@ class AssignUnitObjectiveOnly(BaseCommand):
             method = "queued"
 
         return "%s %s unit %d objective %d (one of %s)" % (self.player, method,
-            self.unit, self.objective, ', '.join(_get_objective(self.objective)))
+            self.unit, self.objective, _objective_strings[self.objective][0])
 
 
 class MarkUnit(BaseCommand):
+    __slots__ = ('unit',)
     _data_struct = struct.Struct("<H")
 
-    def __init__(self, timestamp, message, player, data):
-        super(MarkUnit, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.unit, = MarkUnit._data_struct.unpack(data)
 
     def __str__(self):
@@ -293,11 +538,14 @@ class MarkUnit(BaseCommand):
 
 
 class UndoForUnit(BaseCommand):
+    __slots__ = ('unit', 'end_time', 'start_time')
     _data_struct = struct.Struct("<HI")
 
-    def __init__(self, timestamp, message, player, data):
-        super(UndoForUnit, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.unit, self.end_time = UndoForUnit._data_struct.unpack_from(data)
+
+    def _attach(self, timestamp, player):
+        super(UndoForUnit, self)._attach(timestamp, player)
         self.start_time = self.player.time_position
 
     def __str__(self):
@@ -307,10 +555,10 @@ class UndoForUnit(BaseCommand):
 
 
 class SetBookmark(BaseCommand):
+    __slots__ = ('bookmark_number',)
     _data_struct = struct.Struct("<B")
 
-    def __init__(self, timestamp, message, player, data):
-        super(SetBookmark, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.bookmark_number, = SetBookmark._data_struct.unpack(data)
 
     def __str__(self):
@@ -318,10 +566,10 @@ class SetBookmark(BaseCommand):
 
 
 class JumpToBookmark(BaseCommand):
+    __slots__ = ('bookmark_number',)
     _data_struct = struct.Struct("<B")
 
-    def __init__(self, timestamp, message, player, data):
-        super(JumpToBookmark, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.bookmark_number, = JumpToBookmark._data_struct.unpack(data)
 
     def __str__(self):
@@ -329,10 +577,10 @@ class JumpToBookmark(BaseCommand):
 
 
 class CreateAlliance(BaseCommand):
+    __slots__ = ('new_ally',)
     _data_struct = struct.Struct("<B")
 
-    def __init__(self, timestamp, message, player, data):
-        super(CreateAlliance, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.new_ally, = CreateAlliance._data_struct.unpack(data)
 
     def __str__(self):
@@ -340,10 +588,10 @@ class CreateAlliance(BaseCommand):
 
 
 class BreakAlliance(BaseCommand):
+    __slots__ = ('former_ally',)
     _data_struct = struct.Struct("<B")
 
-    def __init__(self, timestamp, message, player, data):
-        super(BreakAlliance, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.former_ally, = BreakAlliance._data_struct.unpack(data)
 
     def __str__(self):
@@ -351,10 +599,10 @@ class BreakAlliance(BaseCommand):
 
 
 class ShareVision(BaseCommand):
+    __slots__ = ('recipient',)
     _data_struct = struct.Struct("<B")
 
-    def __init__(self, timestamp, message, player, data):
-        super(ShareVision, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.recipient, = ShareVision._data_struct.unpack(data)
 
     def __str__(self):
@@ -362,20 +610,20 @@ class ShareVision(BaseCommand):
 
 
 class RevokeVision(BaseCommand):
+    __slots__ = ('recipient',)
     _data_struct = struct.Struct("<B")
 
-    def __init__(self, timestamp, message, player, data):
-        super(RevokeVision, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.recipient, = RevokeVision._data_struct.unpack(data)
 
     def __str__(self):
         return "%s stops sharing vision with %s" % (self.player, self.recipient)
 
 class ShareControl(BaseCommand):
+    __slots__ = ('recipient',)
     _data_struct = struct.Struct("<B")
 
-    def __init__(self, timestamp, message, player, data):
-        super(ShareControl, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.recipient, = ShareControl._data_struct.unpack(data)
 
     def __str__(self):
@@ -383,10 +631,10 @@ class ShareControl(BaseCommand):
 
 
 class RevokeControl(BaseCommand):
+    __slots__ = ('recipient',)
     _data_struct = struct.Struct("<B")
 
-    def __init__(self, timestamp, message, player, data):
-        super(RevokeControl, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.recipient, = RevokeControl._data_struct.unpack(data)
 
     def __str__(self):
@@ -394,64 +642,80 @@ class RevokeControl(BaseCommand):
 
 
 class SwitchFastForward(BaseCommand):
-    def __init__(self, timestamp, message, player, data):
-        super(SwitchFastForward, self).__init__(timestamp, message, player, data)
-        self.player._time_speed_factor = 2
+    __slots__ = ()
+    _stateful = True
+    _speed_factor = 2
+
+    def _attach(self, timestamp, player):
+        super(SwitchFastForward, self)._attach(timestamp, player)
+        self.player._time_speed_factor = self._speed_factor
 
     def __str__(self):
         return "%s switches to fast forward" % self.player
 
 
 class SwitchSlowMotion(BaseCommand):
-    def __init__(self, timestamp, message, player, data):
-        super(SwitchSlowMotion, self).__init__(timestamp, message, player, data)
-        self.player._time_speed_factor = 0.5
+    __slots__ = ()
+    _stateful = True
+    _speed_factor = 0.5
+
+    def _attach(self, timestamp, player):
+        super(SwitchSlowMotion, self)._attach(timestamp, player)
+        self.player._time_speed_factor = self._speed_factor
 
     def __str__(self):
         return "%s switches to slow motion" % self.player
 
 
 class SwitchPause(BaseCommand):
-    def __init__(self, timestamp, message, player, data):
-        super(SwitchPause, self).__init__(timestamp, message, player, data)
-        self.player._time_speed_factor = 0
+    __slots__ = ()
+    _stateful = True
+    _speed_factor = 0
+
+    def _attach(self, timestamp, player):
+        super(SwitchPause, self)._attach(timestamp, player)
+        self.player._time_speed_factor = self._speed_factor
 
     def __str__(self):
         return "%s pauses" % self.player
 
 
 class SwitchNormalTime(BaseCommand):
-    def __init__(self, timestamp, message, player, data):
-        super(SwitchNormalTime, self).__init__(timestamp, message, player, data)
-        self.player._time_speed_factor = 1
+    __slots__ = ()
+    _stateful = True
+    _speed_factor = 1
+
+    def _attach(self, timestamp, player):
+        super(SwitchNormalTime, self)._attach(timestamp, player)
+        self.player._time_speed_factor = self._speed_factor
 
     def __str__(self):
         return "%s switched to normal time" % self.player
 
 
 class SetConfigurationParameter(GameMessage):
-    def __init__(self, timestamp, message, player, data):
-        super(SetConfigurationParameter, self).__init__(timestamp, message, player, data)
+    __slots__ = ('key', 'val')
+
+    def _decode(self, data):
         self.key, offset = _read_string("B", data)
-        self.val = data[offset:].decode("ascii")
+        self.val = str(data[offset:], "ascii")
 
     def __str__(self):
         return "Set %s to %s" % (self.key, self.val)
 
 
 class ReloadScripts(BaseCommand):
-    def __init__(self, timestamp, message, player, data):
-        super(ReloadScripts, self).__init__(timestamp, message, player, data)
+    __slots__ = ()
 
     def __str__(self):
         return "%s reloads the scripts" % self.player
 
 
 class DeleteNextCommand(BaseCommand):
+    __slots__ = ('unit', 'direction')
     _data_struct = struct.Struct("<HB")
 
-    def __init__(self, timestamp, message, player, data):
-        super(DeleteNextCommand, self).__init__(timestamp, message, player, data)
+    def _decode(self, data):
         self.unit, self.direction = DeleteNextCommand._data_struct.unpack(data)
 
     def __str__(self):
@@ -461,136 +725,2620 @@ class DeleteNextCommand(BaseCommand):
             return "%s jumps to it %d's previous command and deletes it" % (self.player, self.unit)
 
 
-def make_replay_message(timestamp, message_type, message, player, data):
-    return {
-        MessageType.NO_MESSAGE: NoOpMessage,
-        MessageType.MESSAGE: make_message,
-        MessageType.NEW_CLIENT: NewClientMessage,
-        MessageType.NEW_BANNED_CLIENT: NewBannedClientMessage,
-        MessageType.DISCONNECTED: DisconnectedMessage,
-        MessageType.ERROR: ErrorMessage
-    }[message_type](timestamp, message, player, data)
+def make_replay_message(timestamp, message_type, message, player, data,
+                        lazy=False):
+    return _replay_message_types[message_type](timestamp, message, player,
+                                               data, lazy)
 
 
-def make_message(timestamp, message, player, data):
-    return {
-        MessageContentType.CHRONAL_COMMANDS: make_command,
-        MessageContentType.SEND_TEXT: PrivateChatMessage,
-        MessageContentType.BROADCAST_TEXT: PublicChatMessage,
-        MessageContentType.UNPAUSE_ENGINE: UnpauseEngine,
-        MessageContentType.PAUSE_ENGINE: PauseEngine,
-        MessageContentType.SAVE_GAME: SaveGame,
-        MessageContentType.SURRENDER: PlayerSurrender,
-        MessageContentType.GLOBAL_TIME_RATE_CHANGE_REQUEST: GlobalTimeRateChange,
-        MessageContentType.SET_CONFIGURATION_PARAMETER: SetConfigurationParameter
-    }[message](timestamp, message, player, data)
+def make_message(timestamp, message, player, data, lazy=False):
+    return _message_types[message](timestamp, message, player, data, lazy)
 
 
 _command_struct = struct.Struct("<B")
 
 
-def make_command(timestamp, message, player, data):
+def make_command(timestamp, message, player, data, lazy=False):
+    return _filter_commands(timestamp, message, player, data, None, lazy)
+
+
+def _filter_replay_message(timestamp, message_type, message, player, data,
+                           types, lazy=False):
+    """Like make_replay_message, but only construct instances of types.
+
+    Messages of other types are still constructed if they are _stateful, and
+    otherwise only update the player's timestamp without decoding anything.
+    Returns a message, a list of messages or None.
+    """
+    factory = _replay_message_types[message_type]
+    if factory is make_message:
+        if message == MessageContentType.CHRONAL_COMMANDS:
+            return _filter_commands(timestamp, message, player, data, types,
+                                    lazy)
+        factory = _message_types[message]
+
+    if factory._stateful or issubclass(factory, types):
+        return factory(timestamp, message, player, data, lazy)
+    if factory._updates_timestamp and isinstance(player, Player):
+        player._update_timestamp(timestamp)
+    return None
+
+
+def _filter_commands(timestamp, message, player, data, types, lazy=False,
+                     timer=None):
+    """Decode the commands of a CHRONAL_COMMANDS payload, skipping over those
+    that _filter_replay_message would not construct; with types None, all of
+    them are constructed, as by make_command.
+
+    If timer is given, timer(command_class, size, start) is called after each
+    command, with its size including the command number and the
+    time.perf_counter() from before it.
+    """
+    data = memoryview(data)
     command_count, = _command_struct.unpack_from(data)
-    data = data[_command_struct.size:]
+    offset = _command_struct.size
     results = []
 
+    if types is not None and command_count and isinstance(player, Player):
+        player._update_timestamp(timestamp)
+
     for i in range(command_count):
-        command_number, = _command_struct.unpack_from(data)
-        data = data[_command_struct.size:]
-
-        command = {
-            CommandType.MOVE_TIME_POSITION: MoveTimePosition,
-            CommandType.FOLLOW_TO_TIME: MoveTimePosition,
-            CommandType.ASSIGN_UNIT_OBJECTIVE: AssignUnitObjective,
-            CommandType.ASSIGN_UNIT_OBJECTIVE_ONLY: AssignUnitObjectiveOnly,
-            CommandType.MARK_UNIT: MarkUnit,
-            CommandType.DELETE_EVENTS: UndoForUnit,
-            CommandType.SET_BOOKMARK: SetBookmark,
-            CommandType.JUMP_TO_BOOKMARK: JumpToBookmark,
-            CommandType.CREATE_ALLIANCE: CreateAlliance,
-            CommandType.BREAK_ALLIANCE: BreakAlliance,
-            CommandType.GIVE_COMMAND_ABILITY_TO_PLAYER: ShareControl,
-            CommandType.REVOKE_COMMAND_ABILITY_FROM_PLAYER: RevokeControl,
-            CommandType.FAST_TIME: SwitchFastForward,
-            CommandType.SLOW_TIME: SwitchSlowMotion,
-            CommandType.STOP_TIME: SwitchPause,
-            CommandType.NORMAL_TIME: SwitchNormalTime,
-            CommandType.DEBUG_RELOAD_SCRIPTS: ReloadScripts,
-            CommandType.DELETE_NEXT_COMMAND_AND_JUMP_TO_TIME: None,
-        }[command_number]
-
-        results.append(command(timestamp, message, player, data))
-        data = data[command._data_struct.size:]
+        if timer is not None:
+            start = time.perf_counter()
+        command_number, = _command_struct.unpack_from(data, offset)
+        offset += _command_struct.size
+
+        command = _command_types[command_number]
+        if types is None or command._stateful or issubclass(command, types):
+            decoded, size = command._decode_at(timestamp, message, player,
+                                               data, offset, lazy)
+            decoded.command_type = command_number
+            results.append(decoded)
+        else:
+            size = command._data_struct.size
+        offset += size
+        if timer is not None:
+            timer(command, _command_struct.size + size, start)
 
     return results
 
 
+_replay_message_types = {
+    MessageType.NO_MESSAGE: NoOpMessage,
+    MessageType.MESSAGE: make_message,
+    MessageType.NEW_CLIENT: NewClientMessage,
+    MessageType.NEW_BANNED_CLIENT: NewBannedClientMessage,
+    MessageType.DISCONNECTED: DisconnectedMessage,
+    MessageType.ERROR: ErrorMessage
+}
+
+_message_types = {
+    MessageContentType.CHRONAL_COMMANDS: make_command,
+    MessageContentType.SEND_TEXT: PrivateChatMessage,
+    MessageContentType.BROADCAST_TEXT: PublicChatMessage,
+    MessageContentType.UNPAUSE_ENGINE: UnpauseEngine,
+    MessageContentType.PAUSE_ENGINE: PauseEngine,
+    MessageContentType.SAVE_GAME: SaveGame,
+    MessageContentType.SURRENDER: PlayerSurrender,
+    MessageContentType.GLOBAL_TIME_RATE_CHANGE_REQUEST: GlobalTimeRateChange,
+    MessageContentType.SET_CONFIGURATION_PARAMETER: SetConfigurationParameter
+}
+
+_command_types = {
+    CommandType.MOVE_TIME_POSITION: MoveTimePosition,
+    CommandType.FOLLOW_TO_TIME: MoveTimePosition,
+    CommandType.ASSIGN_UNIT_OBJECTIVE: AssignUnitObjective,
+    CommandType.ASSIGN_UNIT_OBJECTIVE_ONLY: AssignUnitObjectiveOnly,
+    CommandType.MARK_UNIT: MarkUnit,
+    CommandType.DELETE_EVENTS: UndoForUnit,
+    CommandType.SET_BOOKMARK: SetBookmark,
+    CommandType.JUMP_TO_BOOKMARK: JumpToBookmark,
+    CommandType.CREATE_ALLIANCE: CreateAlliance,
+    CommandType.BREAK_ALLIANCE: BreakAlliance,
+    CommandType.GIVE_COMMAND_ABILITY_TO_PLAYER: ShareControl,
+    CommandType.REVOKE_COMMAND_ABILITY_FROM_PLAYER: RevokeControl,
+    CommandType.FAST_TIME: SwitchFastForward,
+    CommandType.SLOW_TIME: SwitchSlowMotion,
+    CommandType.STOP_TIME: SwitchPause,
+    CommandType.NORMAL_TIME: SwitchNormalTime,
+    CommandType.DEBUG_RELOAD_SCRIPTS: ReloadScripts,
+    CommandType.DELETE_NEXT_COMMAND_AND_JUMP_TO_TIME: None,
+}
+
+
+class ReplayIndex(object):
+    """Snapshots of the players' state at intervals through a replay.
+
+    Each checkpoint is a (timestamp, offset, players) tuple, where offset is
+    that of the first record with the given timestamp and players lists the
+    (seat, player state) pairs of the seat map just before that record.
+    Build one with Replay.build_index.
+    """
+    _format_version = 1
+
+    def __init__(self, size, interval, checkpoints):
+        self.size = size
+        self.interval = interval
+        self.checkpoints = checkpoints
+        self._timestamps = [checkpoint[0] for checkpoint in checkpoints]
+
+    def checkpoint_before(self, timestamp):
+        """Return the last checkpoint at or before timestamp, or None."""
+        i = bisect.bisect_right(self._timestamps, timestamp)
+        if i == 0:
+            return None
+        return self.checkpoints[i - 1]
+
+    def save(self, path):
+        with open(path, 'w') as index_file:
+            json.dump({
+                'version': ReplayIndex._format_version,
+                'size': self.size,
+                'interval': self.interval,
+                'checkpoints': self.checkpoints
+            }, index_file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as index_file:
+            index = json.load(index_file)
+        if index.get('version') != ReplayIndex._format_version:
+            raise ValueError("Unsupported replay index version %r"
+                             % index.get('version'))
+        return cls(index['size'], index['interval'],
+                   [tuple(checkpoint) for checkpoint in index['checkpoints']])
+
+
+class UnitIndex(object):
+    """The orders given to each unit in a replay.
+
+    For every unit, history returns parallel arrays with an entry per
+    AssignUnitObjective, AssignUnitObjectiveOnly, MarkUnit, UndoForUnit or
+    DeleteNextCommand command naming it. DeleteNextCommand is not decoded
+    from replays yet (its CommandType maps to None in _command_types), so
+    only appears once it is. Build one with Replay.build_unit_index.
+    """
+    _fields = (
+        ('position', 'L'),       # index of the command in Replay.messages()
+        ('timestamp', 'L'),
+        ('seat', 'B'),
+        ('command_type', 'B'),
+        ('time_position', 'q'),  # the player's, when giving the command
+        ('objective', 'b')       # -1 for commands without one
+    )
+
+    def __init__(self):
+        self._units = {}
+
+    def _add(self, position, command):
+        columns = self._units.get(command.unit)
+        if columns is None:
+            columns = self._units[command.unit] = tuple(
+                array.array(typecode) for name, typecode in UnitIndex._fields)
+        objective = getattr(command, 'objective', -1)
+        for column, value in zip(columns, (position, command.timestamp,
+                                           command.player.seat,
+                                           command.command_type,
+                                           command.time_position, objective)):
+            column.append(value)
+
+    def units(self):
+        """Return the ids of the units that were given orders, in order."""
+        return sorted(self._units)
+
+    def __contains__(self, unit):
+        return unit in self._units
+
+    def history(self, unit):
+        """Return a dict of the arrays of the unit's orders, keyed by the
+        names in _fields, with the candidate names of each objective (None
+        for commands without one) under objective_names."""
+        columns = self._units.get(unit)
+        if columns is None:
+            columns = tuple(array.array(typecode)
+                            for name, typecode in UnitIndex._fields)
+        history = dict((name, column) for (name, typecode), column
+                       in zip(UnitIndex._fields, columns))
+        history['objective_names'] = [
+            None if objective < 0 else _objective_names[objective][
+                command_type == CommandType.ASSIGN_UNIT_OBJECTIVE]
+            for command_type, objective in zip(history['command_type'],
+                                               history['objective'])]
+        return history
+
+
 class Replay(object):
     _header_struct1 = struct.Struct("<5s4B")
     _header_struct2 = struct.Struct("<IH")
     _body_struct = struct.Struct("<I3B")
+    _length_struct = struct.Struct("<I")
+    _scan_chunk_size = 1 << 16
+
+    def __init__(self, source):
+        """Read the replay header from source.
+
+        source is either the replay contents as a bytes-like object, or a path
+        or file descriptor of a replay file, which is memory-mapped instead of
+        being read into memory. Payloads are handed out as memoryviews into
+        source, so neither the file nor individual messages are copied.
+        """
+        self._mmap = None
+        if isinstance(source, int):
+            self._mmap = source = mmap.mmap(source, 0, access=mmap.ACCESS_READ)
+        elif isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as replay_file:
+                self._mmap = source = mmap.mmap(replay_file.fileno(), 0,
+                                                access=mmap.ACCESS_READ)
+        data = memoryview(source)
+
+        (self.version, self.map_path, self.random_seed, self.player_seats,
+         offset) = Replay._read_header(data)
 
-    def __init__(self, data):
+        self._data = data
+        self._base_offset = offset
+        self.index = None
+
+    @staticmethod
+    def _read_header(data):
+        """Return the version, map path, random seed and player seats from the
+        header in data, and the offset of the first record after it."""
         header = Replay._header_struct1.unpack_from(data)
 
         magic = header[0]
         assert(magic == b"CRRP\x00")
 
-        self.version = header[1:5]
+        version = header[1:5]
 
-        self.map_path, offset = _read_string('H', data, Replay._header_struct1.size)
+        map_path, offset = _read_string('H', data, Replay._header_struct1.size)
 
-        self.random_seed, seat_mask = Replay._header_struct2.unpack_from(data, offset)
+        random_seed, seat_mask = Replay._header_struct2.unpack_from(data, offset)
         offset += Replay._header_struct2.size
 
-        self.player_seats = _unpack_bitmask(seat_mask, 16)
-
-        self._data = data
-        self._base_offset = offset
+        return version, map_path, random_seed, _unpack_bitmask(seat_mask, 16), offset
+
+    def close(self):
+        """Unmap the replay file, if it was opened from a path or descriptor."""
+        if self._mmap is None:
+            return
+        self._data.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Payload views handed out by raw_messages are still alive; the
+            # mapping goes away once they are garbage collected.
+            pass
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _record_offsets(self):
+        """Return an array of the offsets of all record headers.
+
+        Only the length prefix of each record is read, to find the next one.
+        """
+        data = self._data
+        end = len(data)
+        offsets = array.array('Q')
+        append = offsets.append
+        unpack_length = Replay._length_struct.unpack_from
+        length_offset = Replay._body_struct.size
+        header_size = length_offset + Replay._length_struct.size
 
-    def raw_messages(self):
         offset = self._base_offset
+        while offset + header_size <= end:
+            append(offset)
+            length, = unpack_length(data, offset + length_offset)
+            offset += header_size + length
+        if offset != end:
+            raise ValueError("Replay ends with a truncated record")
+        return offsets
+
+    def scan(self):
+        """Return a numpy structured array describing every record.
+
+        The array has the fields timestamp, msg_type, message (the content
+        type), seat, offset and length, where offset and length locate the
+        record's payload in the replay. Payloads are not decoded, so this is
+        suited to statistics over whole replays, e.g.
+        numpy.bincount(replay.scan()['msg_type']).
+        """
+        _require_numpy("Replay.scan")
+        header_dtype = numpy.dtype([
+            ('timestamp', '<u4'),
+            ('msg_type', 'u1'),
+            ('message', 'u1'),
+            ('seat', 'u1'),
+            ('length', '<u4')
+        ])
+        offsets = numpy.frombuffer(self._record_offsets(), dtype=numpy.uint64)
+        raw = numpy.frombuffer(self._data, dtype=numpy.uint8)
+        header_bytes = numpy.arange(header_dtype.itemsize, dtype=numpy.intp)
+
+        records = numpy.empty(len(offsets), dtype=[
+            ('timestamp', '<u4'),
+            ('msg_type', 'u1'),
+            ('message', 'u1'),
+            ('seat', 'u1'),
+            ('offset', '<u8'),
+            ('length', '<u4')
+        ])
+        # Gather the fixed-size headers in chunks to bound the size of the
+        # temporary index array.
+        for start in range(0, len(offsets), Replay._scan_chunk_size):
+            chunk = offsets[start:start + Replay._scan_chunk_size]
+            byte_index = chunk.astype(numpy.intp)[:, numpy.newaxis] + header_bytes
+            headers = raw[byte_index].view(header_dtype)[:, 0]
+            out = records[start:start + len(chunk)]
+            for field in ('timestamp', 'msg_type', 'message', 'seat', 'length'):
+                out[field] = headers[field]
+        records['offset'] = offsets + header_dtype.itemsize
+        return records
+
+    def timeline(self, records=None):
+        """Return the time position of the seat's player after every record.
+
+        records is the result of scan(), which is called if it is not given.
+        Returns a numpy structured array with a row per record and the fields
+        time_position and speed_factor, which are -1 and nan for records of
+        empty seats. All commands in a CHRONAL_COMMANDS record share its row.
+        The values are the same as those of Player, but are computed a seat
+        at a time with cumulative sums instead of a message at a time.
+        """
+        _require_numpy("Replay.timeline")
+        if records is None:
+            records = self.scan()
+        raw = numpy.frombuffer(self._data, dtype=numpy.uint8)
+        count = len(records)
+        msg_type = records['msg_type']
+
+        # Jumps and speed changes of CHRONAL_COMMANDS records, found by
+        # walking the commands of all records at once.
+        command_sizes = numpy.full(256, -1, dtype=numpy.int64)
+        speed_factors = numpy.full(256, numpy.nan)
+        jumps = numpy.zeros(256, dtype=bool)
+        for number, command in _command_types.items():
+            if command is not None:
+                command_sizes[number] = command._data_struct.size
+                speed_factors[number] = getattr(command, '_speed_factor',
+                                                numpy.nan)
+                jumps[number] = issubclass(command, MoveTimePosition)
+
+        chronal = numpy.flatnonzero(
+            (msg_type == MessageType.MESSAGE) &
+            (records['message'] == MessageContentType.CHRONAL_COMMANDS))
+        position = records['offset'][chronal].astype(numpy.int64)
+        remaining = raw[position].astype(numpy.int64)
+        position += 1
+        jump_target = numpy.full(count, -1, dtype=numpy.int64)
+        speed_change = numpy.full(count, numpy.nan)
+        while True:
+            active = numpy.flatnonzero(remaining > 0)
+            if not len(active):
+                break
+            rows, at = chronal[active], position[active]
+            command_type = raw[at]
+            if (command_sizes[command_type] < 0).any():
+                raise ValueError("Unsupported command type in replay")
+            # Later commands in a record override earlier ones.
+            jumped = jumps[command_type]
+            target = raw[at[jumped][:, numpy.newaxis] +
+                         numpy.arange(1, 5)].astype(numpy.int64)
+            jump_target[rows[jumped]] = target @ (1 << numpy.arange(0, 32, 8))
+            changed = ~numpy.isnan(speed_factors[command_type])
+            speed_change[rows[changed]] = speed_factors[command_type[changed]]
+            position[active] += 1 + command_sizes[command_type]
+            remaining[active] -= 1
+
+        result = numpy.empty(count, dtype=[('time_position', '<i8'),
+                                           ('speed_factor', '<f8')])
+        result['time_position'] = -1
+        result['speed_factor'] = numpy.nan
+        # Records that call Player._update_timestamp; a CHRONAL_COMMANDS
+        # record only does so through its commands.
+        updates = ~numpy.isin(msg_type, (MessageType.NO_MESSAGE,
+                                         MessageType.NEW_BANNED_CLIENT))
+        updates[chronal] = raw[records['offset'][chronal]] > 0
+
+        for seat in numpy.unique(records['seat']):
+            rows = numpy.flatnonzero(records['seat'] == seat)
+            self._seat_timeline(rows, records['timestamp'][rows],
+                                msg_type[rows], updates[rows],
+                                jump_target[rows], speed_change[rows], result)
+        return result
+
+    @staticmethod
+    def _seat_timeline(rows, timestamp, msg_type, updates, jump_target,
+                       speed_change, result):
+        # Whether the seat has a player after each record, and whether each
+        # record is a join that creates a new Player.
+        membership = numpy.full(len(rows), -1, dtype=numpy.int8)
+        membership[msg_type == MessageType.NEW_CLIENT] = 1
+        membership[msg_type == MessageType.DISCONNECTED] = 0
+        last_change = numpy.maximum.accumulate(numpy.where(
+            membership >= 0, numpy.arange(len(rows)), -1))
+        occupied_after = (last_change >= 0) & \
+            (membership[numpy.maximum(last_change, 0)] == 1)
+        occupied_before = numpy.concatenate(([False], occupied_after[:-1]))
+        joined = (msg_type == MessageType.NEW_CLIENT) & ~occupied_before
+        occupied = occupied_before | joined
+        updating = numpy.flatnonzero(occupied & updates)
+        if not len(updating):
+            return
+
+        timestamp = timestamp[updating].astype(numpy.int64)
+        joined_u = joined[updating]
+        # Speed factor after each update, reset to 1 by joins.
+        factor_after = numpy.where(joined_u, 1.0, speed_change[updating])
+        changes = numpy.flatnonzero(~numpy.isnan(factor_after))
+        filled = numpy.full(len(updating), -1)
+        filled[changes] = changes
+        filled = numpy.maximum.accumulate(filled)
+        factor_after = numpy.where(filled >= 0,
+                                   factor_after[numpy.maximum(filled, 0)], 1.0)
+        factor_before = numpy.concatenate(([1.0], factor_after[:-1]))
+        factor_before[joined_u] = 1.0
+        last_timestamp = numpy.concatenate(([0], timestamp[:-1]))
+        last_timestamp[joined_u] = 0
+
+        # Player._update_timestamp truncates every increment, so sum the
+        # truncated increments, restarting the sum at joins and jumps.
+        increments = numpy.trunc((timestamp - last_timestamp) / 2.0 *
+                                 factor_before).astype(numpy.int64)
+        totals = numpy.cumsum(increments)
+        jumped = jump_target[updating] >= 0
+        anchors = numpy.flatnonzero(joined_u | jumped)
+        bases = numpy.where(jumped[anchors], jump_target[updating][anchors],
+                            increments[anchors]) - totals[anchors]
+        anchor = numpy.full(len(updating), -1)
+        anchor[anchors] = numpy.arange(len(anchors))
+        anchor = numpy.maximum.accumulate(anchor)
+        time_position = totals + bases[anchor]
+
+        # Records that do not update the player keep the last position.
+        last_update = numpy.full(len(rows), -1)
+        last_update[updating] = numpy.arange(len(updating))
+        last_update = numpy.maximum.accumulate(last_update)
+        shown = numpy.flatnonzero(occupied & (last_update >= 0))
+        result['time_position'][rows[shown]] = \
+            time_position[last_update[shown]]
+        result['speed_factor'][rows[shown]] = factor_after[last_update[shown]]
+
+    def build_index(self, interval=GAME_TICKS_PER_SECOND * 60):
+        """Build a ReplayIndex with a checkpoint roughly every interval ticks.
+
+        The index is also kept as self.index, which messages and seek use to
+        start decoding from the nearest checkpoint instead of from the start
+        of the replay. Timestamps are assumed to never decrease.
+        """
+        player_seat_map = {}
+        checkpoints = []
+
+        def records():
+            next_checkpoint = 0
+            last_timestamp = None
+            for offset, record in zip(self._record_offsets(),
+                                      self.raw_messages()):
+                timestamp = record[0]
+                # Only checkpoint at the first record of a timestamp, so no
+                # record before the checkpoint shares its timestamp.
+                if timestamp >= next_checkpoint and timestamp != last_timestamp:
+                    checkpoints.append((timestamp, offset, [
+                        (seat, player._get_state())
+                        for seat, player in sorted(player_seat_map.items())
+                    ]))
+                    next_checkpoint = timestamp + interval
+                last_timestamp = timestamp
+                yield record
+
+        for message in _replay_messages(records(), player_seat_map, types=()):
+            pass
+
+        self.index = ReplayIndex(len(self._data), interval, checkpoints)
+        return self.index
+
+    def build_unit_index(self):
+        """Return a UnitIndex of the orders given to every unit.
+
+        This decodes the replay once, lazily, so only the payloads of the
+        commands that name a unit are decoded.
+        """
+        index = UnitIndex()
+        unit_commands = (AssignUnitObjective, AssignUnitObjectiveOnly,
+                         MarkUnit, UndoForUnit, DeleteNextCommand)
+        for position, message in enumerate(self.messages(lazy=True)):
+            if isinstance(message, unit_commands):
+                index._add(position, message)
+        return index
+
+    def clip(self, target, time_range=None, seats=None):
+        """Write the records in time_range and of seats to a new replay.
+
+        target is as for ReplayWriter, and time_range and seats are as for
+        messages. The header is copied, as are the joins of the players who
+        are still seated when time_range starts, so the clip's messages are
+        attributed to the same players. Records are copied as they are,
+        without decoding them, and consecutive records are written at once.
+        Timestamps are assumed to never decrease. Returns the number of
+        records written.
+
+        Players' time positions only match those of the original replay if
+        the clip starts with it, since the records that advanced them are
+        left out.
+        """
+        start, end = (None, None) if time_range is None else time_range
+        data = self._data
+        size = len(data)
+        unpack_header = _record_header_struct.unpack_from
+        header_size = _record_header_struct.size
+        # The records that made the players seated before start join, as
+        # (offset, end) pairs; None once they have been written.
+        joins = {}
+        count = 0
+        run_start = run_end = None
+
+        with ReplayWriter(target, self.map_path, self.random_seed,
+                          self.player_seats, self.version) as writer:
+            offset = self._base_offset
+            while offset < size:
+                if offset + header_size > size:
+                    raise ValueError("Replay ends with a truncated record")
+                timestamp, msg_type, message, seat, length = \
+                    unpack_header(data, offset)
+                record_end = offset + header_size + length
+                if record_end > size:
+                    raise ValueError("Replay ends with a truncated record")
+                if end is not None and timestamp >= end:
+                    break
+                if seats is None or seat in seats:
+                    if start is not None and timestamp < start:
+                        if msg_type == MessageType.NEW_CLIENT:
+                            joins.setdefault(seat, (offset, record_end))
+                        elif msg_type == MessageType.DISCONNECTED:
+                            joins.pop(seat, None)
+                    else:
+                        if joins is not None:
+                            count += self._write_joins(writer, joins)
+                            joins = None
+                        if offset != run_end:
+                            if run_end is not None:
+                                writer.write_raw_records(
+                                    data[run_start:run_end])
+                            run_start = offset
+                        run_end = record_end
+                        count += 1
+                offset = record_end
+
+            if joins is not None:
+                count += self._write_joins(writer, joins)
+            if run_end is not None:
+                writer.write_raw_records(data[run_start:run_end])
+        return count
+
+    def _write_joins(self, writer, joins):
+        for offset, end in sorted(joins.values()):
+            writer.write_raw_records(self._data[offset:end])
+        return len(joins)
+
+    def load_index(self, path):
+        """Load an index saved with ReplayIndex.save and use it for seeking."""
+        index = ReplayIndex.load(path)
+        if index.size != len(self._data):
+            raise ValueError("Replay index %s does not belong to this replay"
+                             % path)
+        self.index = index
+        return index
+
+    def seek(self, timestamp, **kwargs):
+        """Iterate over the messages from timestamp onwards.
+
+        Takes the same keyword arguments as messages.
+        """
+        end = kwargs.pop('time_range', (None, None))[1]
+        return self.messages(time_range=(timestamp, end), **kwargs)
+
+    def raw_messages(self, offset=None, errors=None):
+        """Iterate over the records of the replay as (timestamp, msg_type,
+        message, seat, payload) tuples.
+
+        If errors is a list, bytes that do not form plausible records are
+        skipped up to the next offset from which records look valid again,
+        with a RecordError appended to errors for each skipped stretch.
+        """
+        if offset is None:
+            offset = self._base_offset
+        if errors is not None:
+            for record in _tolerant_records(self._data, offset, errors):
+                yield record
+            return
         while offset < len(self._data):
             timestamp, msg_type, message, seat = Replay._body_struct.unpack_from(self._data, offset)
             offset += Replay._body_struct.size
             params, offset = _read_length_prefixed_field('I', self._data, offset)
             yield timestamp, msg_type, message, seat, params
 
-    def messages(self):
+    def messages(self, types=None, seats=None, time_range=None, lazy=False,
+                 stats=None, errors=None):
+        """Iterate over the messages of the replay.
+
+        types (a message class or tuple of classes), seats (a collection of
+        seat numbers) and time_range (a (start, end) pair of timestamps, with
+        end exclusive and either bound possibly None) restrict which messages
+        are yielded. Payloads of records that cannot match are not decoded;
+        only their effect on player state is applied.
+
+        If lazy is true, payload fields are decoded on first access, so the
+        replay must not be closed before the messages are done with.
+
+        If the replay has an index and time_range has a start, decoding
+        resumes from the last checkpoint before it.
+
+        If stats is a ParseStats, the time spent on each kind of message is
+        added to it.
+
+        If errors is a list, parsing is tolerant: a record that cannot be
+        decoded becomes an UnknownMessage, corrupt framing is skipped (see
+        raw_messages), and a RecordError is appended to errors for each.
+        Otherwise the first such problem raises an exception. Payloads that
+        lazy decoding fails on still raise when accessed.
+        """
+        offset, player_seat_map = self._start(time_range)
+        records = self.raw_messages(offset, errors)
+        if stats is not None:
+            records = stats._timed_records(records)
+        return _replay_messages(records, player_seat_map, types, seats,
+                                time_range, lazy, stats, errors)
+
+    async def amessages(self, types=None, seats=None, time_range=None,
+                        lazy=False, stats=None, errors=None, batch_size=1000):
+        """Asynchronously iterate over the messages of the replay.
+
+        Takes the same arguments as messages, and lets other tasks run after
+        every batch_size records, so decoding a large replay does not hold up
+        the event loop for long.
+        """
+        offset, player_seat_map = self._start(time_range)
+        records = self.raw_messages(offset, errors)
+        if stats is not None:
+            records = stats._timed_records(records)
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return
+            for message in _replay_messages(batch, player_seat_map, types,
+                                            seats, time_range, lazy, stats,
+                                            errors):
+                yield message
+            await asyncio.sleep(0)
+
+    def parallel_messages(self, types=None, seats=None, time_range=None,
+                          max_workers=None, chunk_size=1 << 20):
+        """Iterate over the messages of the replay, decoding chunks of about
+        chunk_size bytes in a pool of max_workers processes.
+
+        The replay is split into chunks in a pass that only tracks the
+        players' state, which is then handed to the process decoding the
+        next chunk. The messages and final player state are the same as
+        those of messages with the same arguments, but Players are only
+        brought up to date a chunk at a time, and an error is raised before
+        any message of the chunk it occurs in.
+
+        This does not scale with the number of processes. Splitting the
+        replay and rebuilding the messages the workers send back take this
+        process about 40% of the time of messages, and the workers do about
+        twice the work of messages between them. It is at best about 1.7
+        times as fast as messages, and slower with 2 workers; the command
+        line does not use it.
+        """
+        _require_importable("Replay.parallel_messages", _decode_replay_chunk)
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
         player_seat_map = {}
-        for timestamp, msg_type, message, seat, params in self.raw_messages():
-            player = player_seat_map.get(seat, seat)
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+            pending = collections.deque()
             try:
-                msg = make_replay_message(timestamp, msg_type, message, player, params)
-            except:
-                print("\nERROR parsing replay message:")
-                print("Timestamp: %s" % timestamp)
-                print("Message type: %s" % MessageType.reverse_mapping.get(msg_type, "unknown (number %d)" % msg_type))
-                print("Message content: %s" % MessageContentType.reverse_mapping.get(message, "unknown (number %d)" % message))
-                print("Player: %s" % player)
-                print("Parameters: %s" % params)
-                raise
-
-            if isinstance(msg, NewClientMessage):
-                player_seat_map[seat] = msg.player
-            elif isinstance(msg, DisconnectedMessage):
-                del player_seat_map[seat]
+                for job in self._chunk_jobs(chunk_size, types, seats,
+                                            time_range):
+                    pending.append(executor.submit(_decode_replay_chunk, job))
+                    if len(pending) >= 2 * max_workers:
+                        for message in self._chunk_messages(
+                                pending.popleft().result(), player_seat_map):
+                            yield message
+                while pending:
+                    for message in self._chunk_messages(
+                            pending.popleft().result(), player_seat_map):
+                        yield message
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _chunk_jobs(self, chunk_size, types, seats, time_range):
+        # Jobs for _decode_replay_chunk, each starting at a record boundary.
+        player_seat_map = {}
+        chunk_start = offset = self._base_offset
+        header_size = Replay._body_struct.size + Replay._length_struct.size
+        player_states = []
+        for record in self.raw_messages():
+            if offset - chunk_start >= chunk_size:
+                yield (bytes(self._data[chunk_start:offset]), player_states,
+                       types, seats, time_range)
+                chunk_start = offset
+                player_states = [(seat, player._get_state()) for seat, player
+                                 in sorted(player_seat_map.items())]
+            _advance_players(player_seat_map, *record)
+            offset += header_size + len(record[4])
+        if chunk_start < len(self._data):
+            yield (bytes(self._data[chunk_start:]), player_states, types, seats,
+                   time_range)
+
+    @staticmethod
+    def _chunk_messages(result, player_seat_map):
+        # Rebuild the messages of a chunk decoded by _decode_replay_chunk,
+        # giving players who were seated before it the existing Players, and
+        # update player_seat_map to the seat map after it.
+        class_names, player_states, origins, rows, seated = marshal.loads(result)
+        players = []
+        for state, origin in zip(player_states, origins):
+            if origin < 0:
+                players.append(Player._from_state(state))
+            else:
+                player = player_seat_map[origin]
+                (player.seat, player.name, player.time_position,
+                 player._last_timestamp, player._time_speed_factor) = state
+                players.append(player)
+        player_seat_map.clear()
+        for seat, number in seated:
+            player_seat_map[seat] = players[number]
+        return _messages_from_rows(class_names, players, rows)
+
+    def _start(self, time_range):
+        # The offset and seat map to start decoding from for time_range.
+        if self.index is not None and time_range is not None and \
+                time_range[0] is not None:
+            if self.index.size != len(self._data):
+                raise ValueError("Replay index does not belong to this replay")
+            checkpoint = self.index.checkpoint_before(time_range[0])
+            if checkpoint is not None:
+                timestamp, offset, players = checkpoint
+                return offset, dict((seat, Player._from_state(state))
+                                    for seat, state in players)
+        return None, {}
+
+
+def _complete_records(data, offset=0):
+    """Split data into records like those yielded by Replay.raw_messages.
+
+    Returns the complete records and the offset just past the last of them,
+    which is where a truncated record at the end of data starts.
+    """
+    data = memoryview(data)
+    end = len(data)
+    length_offset = Replay._body_struct.size
+    header_size = length_offset + Replay._length_struct.size
+    records = []
+
+    while offset + header_size <= end:
+        length, = Replay._length_struct.unpack_from(data, offset + length_offset)
+        payload_offset = offset + header_size
+        if payload_offset + length > end:
+            break
+        timestamp, msg_type, message, seat = Replay._body_struct.unpack_from(data, offset)
+        records.append((timestamp, msg_type, message, seat,
+                        data[payload_offset:payload_offset + length]))
+        offset = payload_offset + length
+
+    return records, offset
+
+
+class ReplayFollower(object):
+    """Parse a replay file that is still being written.
+
+    The follower keeps a cursor made up of the offset of the next unparsed
+    record and the players in the seat map, so every poll only reads and
+    decodes the complete records appended since the last one. A record that
+    is only partially written is picked up by a later poll. The header
+    attributes of Replay are None until the header has been written.
+
+    A cursor obtained from the cursor method can be passed to a new follower
+    to resume where a previous one left off. It covers all the messages
+    returned by the last poll.
+    """
+
+    def __init__(self, path, cursor=None, poll_interval=1.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.version = self.map_path = None
+        self.random_seed = self.player_seats = None
+        self.offset = None
+        self.player_seat_map = {}
+        if cursor is not None:
+            self.offset = cursor['offset']
+            self.player_seat_map = dict((seat, Player._from_state(state))
+                                        for seat, state in cursor['players'])
+        self._file = open(path, 'rb')
+        self._buffer = bytearray()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def cursor(self):
+        """Return the follower's position as a JSON-serializable dict."""
+        return {
+            'offset': self.offset,
+            'players': [(seat, player._get_state())
+                        for seat, player in sorted(self.player_seat_map.items())]
+        }
+
+    def _read_header(self):
+        self._file.seek(0)
+        data = self._file.read(Replay._header_struct1.size + 2 + 0xffff +
+                               Replay._header_struct2.size)
+        try:
+            (self.version, self.map_path, self.random_seed, self.player_seats,
+             offset) = Replay._read_header(data)
+        except struct.error:
+            return False
+        if self.offset is None:
+            self.offset = offset
+        return True
+
+    def _size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def poll(self, types=None, seats=None):
+        """Return the messages of the complete records appended since the
+        last poll. types and seats are as for Replay.messages."""
+        if self.map_path is None and not self._read_header():
+            return []
+
+        read_offset = self.offset + len(self._buffer)
+        if self._size() <= read_offset:
+            return []
+        self._file.seek(read_offset)
+        self._buffer += self._file.read()
+
+        records, consumed = _complete_records(self._buffer)
+        messages = list(_replay_messages(records, self.player_seat_map, types,
+                                         seats))
+        del records
+        # Start a new buffer rather than resizing the one the payloads of the
+        # decoded records pointed into.
+        self._buffer = self._buffer[consumed:]
+        self.offset += consumed
+        return messages
+
+    def follow(self, types=None, seats=None, idle_timeout=None):
+        """Yield messages as they are appended to the replay.
+
+        Checks the file size every poll_interval seconds while it is not
+        growing, and stops once it has not grown for idle_timeout seconds, if
+        given.
+        """
+        last_size = None
+        last_growth = time.monotonic()
+        while True:
+            for message in self.poll(types, seats):
+                yield message
+            size = self._size()
+            if size != last_size:
+                last_size = size
+                last_growth = time.monotonic()
+                # Poll again straight away if more was appended meanwhile.
+                if self.offset is not None and \
+                        size > self.offset + len(self._buffer):
+                    continue
+            elif idle_timeout is not None and \
+                    time.monotonic() - last_growth >= idle_timeout:
+                return
+            time.sleep(self.poll_interval)
+
+
+class ReplayStream(object):
+    """Parse a replay read sequentially from a binary file object, such as a
+    pipe, socket or decompressing reader.
+
+    Records are read into a reusable buffer of buffer_size bytes, which only
+    grows if a single record does not fit in it, so memory use does not
+    depend on the length of the replay. The file object is not closed.
+    """
+
+    def __init__(self, fileobj, buffer_size=1 << 16):
+        self._file = fileobj
+        self._buffer = bytearray(buffer_size)
+
+        header = self._read_exact(Replay._header_struct1.size + 2)
+        map_path_length, = struct.unpack_from("<H", header,
+                                              Replay._header_struct1.size)
+        header += self._read_exact(map_path_length + Replay._header_struct2.size)
+        (self.version, self.map_path, self.random_seed, self.player_seats,
+         offset) = Replay._read_header(header)
+
+    def _read_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self._file.read(size - len(data))
+            if not chunk:
+                raise ValueError("Replay ends in its header")
+            data += chunk
+        return data
+
+    def _readinto(self, view):
+        readinto = getattr(self._file, 'readinto', None)
+        if readinto is not None:
+            return readinto(view) or 0
+        chunk = self._file.read(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-            if isinstance(msg, list):
-                for m in msg:
+    def raw_messages(self):
+        """Like Replay.raw_messages, but each payload is a view of the read
+        buffer and is only valid until the next record is requested."""
+        length_offset = Replay._body_struct.size
+        header_size = length_offset + Replay._length_struct.size
+        view = memoryview(self._buffer)
+        start = end = 0
+
+        while True:
+            needed = header_size
+            while end - start >= header_size:
+                length, = Replay._length_struct.unpack_from(view, start + length_offset)
+                payload_offset = start + header_size
+                if payload_offset + length > end:
+                    needed = header_size + length
+                    break
+                timestamp, msg_type, message, seat = Replay._body_struct.unpack_from(view, start)
+                yield (timestamp, msg_type, message, seat,
+                       view[payload_offset:payload_offset + length])
+                start = payload_offset + length
+
+            # Move the start of the next record to the front of the buffer,
+            # into a larger buffer if the whole record does not fit.
+            pending = bytes(view[start:end])
+            if needed > len(view):
+                self._buffer = bytearray(needed)
+                view = memoryview(self._buffer)
+            view[:len(pending)] = pending
+            start, end = 0, len(pending)
+
+            read = self._readinto(view[end:])
+            if not read:
+                if end:
+                    raise ValueError("Replay ends in a truncated record")
+                return
+            end += read
+
+    def messages(self, types=None, seats=None, time_range=None, stats=None,
+                 errors=None):
+        """Iterate over the messages of the replay, see Replay.messages.
+
+        Messages are decoded as they are read, so there is no lazy mode.
+        errors only makes records that cannot be decoded tolerated, as
+        corrupt framing cannot be skipped without seeking.
+        """
+        records = self.raw_messages()
+        if stats is not None:
+            records = stats._timed_records(records)
+        return _replay_messages(records, {}, types, seats, time_range,
+                                stats=stats, errors=errors)
+
+
+class ReplayWriter(object):
+    """Write a replay, e.g. to produce replays for tests and benchmarks.
+
+    target is a path or a binary file object; a file opened from a path is
+    closed by close. player_seats is a list of booleans like
+    Replay.player_seats. The header is written straight away, and records
+    are written with write_record or the helpers for common messages.
+    """
+
+    def __init__(self, target, map_path, random_seed=0, player_seats=(),
+                 version=(1, 0, 0, 0)):
+        if hasattr(target, 'write'):
+            self._file = target
+            self._owns_file = False
+        else:
+            self._file = open(target, 'wb')
+            self._owns_file = True
+
+        seat_mask = 0
+        for seat, present in enumerate(player_seats):
+            if present:
+                seat_mask |= 1 << seat
+        map_path = map_path.encode('ascii')
+        self._file.write(Replay._header_struct1.pack(b"CRRP\x00", *version) +
+                         struct.pack("<H", len(map_path)) + map_path +
+                         Replay._header_struct2.pack(random_seed, seat_mask))
+
+    def close(self):
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_record(self, timestamp, msg_type, message, seat, payload=b""):
+        """Write a record like those yielded by Replay.raw_messages."""
+        self._file.write(_record_header_struct.pack(timestamp, msg_type,
+                                                    message, seat,
+                                                    len(payload)))
+        self._file.write(payload)
+
+    def write_raw_records(self, data):
+        """Write bytes holding complete records, e.g. taken from another
+        replay."""
+        self._file.write(data)
+
+    def write_join(self, timestamp, seat, name):
+        self.write_record(timestamp, MessageType.NEW_CLIENT, 0, seat,
+                          name.encode('ascii'))
+
+    def write_disconnect(self, timestamp, seat):
+        self.write_record(timestamp, MessageType.DISCONNECTED, 0, seat)
+
+    def write_chat(self, timestamp, seat, contents, recipient=None):
+        """Write a public chat message, or a private one if recipient is
+        given."""
+        if recipient is None:
+            self.write_record(timestamp, MessageType.MESSAGE,
+                              MessageContentType.BROADCAST_TEXT, seat,
+                              contents.encode('ascii'))
+        else:
+            self.write_record(timestamp, MessageType.MESSAGE,
+                              MessageContentType.SEND_TEXT, seat,
+                              struct.pack("<B", recipient) +
+                              contents.encode('ascii'))
+
+    def write_commands(self, timestamp, seat, commands):
+        """Write a CHRONAL_COMMANDS message.
+
+        commands is a sequence of tuples of a CommandType followed by the raw
+        values of the command's _data_struct, e.g.
+        (CommandType.MARK_UNIT, unit) or (CommandType.FAST_TIME,).
+        """
+        payload = [_command_struct.pack(len(commands))]
+        for command in commands:
+            payload.append(_command_struct.pack(command[0]))
+            payload.append(_command_types[command[0]]._data_struct.pack(
+                *command[1:]))
+        self.write_record(timestamp, MessageType.MESSAGE,
+                          MessageContentType.CHRONAL_COMMANDS, seat,
+                          b"".join(payload))
+
+
+def _open_replay(path):
+    """Open a replay file, or standard input if path is "-"."""
+    if path == '-':
+        return ReplayStream(sys.stdin.buffer)
+    return Replay(path)
+
+
+class ParseStats(object):
+    """Counts, payload bytes and decoding time per kind of message.
+
+    Pass an instance as the stats argument of Replay.messages to fill it in;
+    without one, parsing is not instrumented at all. Records are counted by
+    the class they decode to, and the commands of CHRONAL_COMMANDS records
+    are also counted individually. framing_time is the time spent splitting
+    the replay into records.
+    """
+
+    def __init__(self):
+        self.framing_time = 0.0
+        self.counts = collections.Counter()
+        self.payload_bytes = collections.Counter()
+        self.decode_times = collections.Counter()
+
+    def _add(self, kind, size, elapsed):
+        self.counts[kind] += 1
+        self.payload_bytes[kind] += size
+        self.decode_times[kind] += elapsed
+
+    def _timed_records(self, records):
+        records = iter(records)
+        while True:
+            start = time.perf_counter()
+            try:
+                record = next(records)
+            except StopIteration:
+                return
+            self.framing_time += time.perf_counter() - start
+            yield record
+
+    def _decode(self, timestamp, msg_type, message, player, data, types,
+                lazy):
+        # Like _filter_replay_message (or make_replay_message if types is
+        # None), timing every record and every command.
+        factory = _replay_message_types.get(msg_type)
+        if factory is make_message:
+            if message == MessageContentType.CHRONAL_COMMANDS:
+                return self._decode_commands(timestamp, message, player, data,
+                                             types, lazy)
+            factory = _message_types.get(message)
+        kind = "unknown" if factory is None else factory.__name__
+
+        start = time.perf_counter()
+        if types is None:
+            msg = make_replay_message(timestamp, msg_type, message, player,
+                                      data, lazy)
+        else:
+            msg = _filter_replay_message(timestamp, msg_type, message, player,
+                                         data, types, lazy)
+        self._add(kind, len(data), time.perf_counter() - start)
+        return msg
+
+    def _decode_commands(self, timestamp, message, player, data, types, lazy):
+        start = time.perf_counter()
+        results = _filter_commands(timestamp, message, player, data, types,
+                                   lazy, self._time_command)
+        self._add("CHRONAL_COMMANDS", len(data), time.perf_counter() - start)
+        return results
+
+    def _time_command(self, command, size, start):
+        self._add(command.__name__, size, time.perf_counter() - start)
+
+    def rows(self):
+        """Return (kind, count, payload bytes, seconds) tuples, the most
+        time-consuming first."""
+        return sorted(((kind, self.counts[kind], self.payload_bytes[kind],
+                        self.decode_times[kind]) for kind in self.counts),
+                      key=lambda row: row[3], reverse=True)
+
+    def to_dict(self):
+        return {
+            'framing_time': self.framing_time,
+            'kinds': [{'kind': kind, 'count': count, 'payload_bytes': size,
+                       'decode_time': elapsed}
+                      for kind, count, size, elapsed in self.rows()]
+        }
+
+    def format_table(self):
+        """Return the statistics as a text table. CHRONAL_COMMANDS rows
+        include the time of the commands in them."""
+        lines = ["%-28s %10s %12s %10s %10s" % ("kind", "count", "bytes",
+                                                 "time (s)", "us each")]
+        for kind, count, size, elapsed in self.rows():
+            lines.append("%-28s %10d %12d %10.3f %10.2f"
+                         % (kind, count, size, elapsed, elapsed * 1e6 / count))
+        lines.append("%-28s %10s %12s %10.3f" % ("(framing)", "", "",
+                                                  self.framing_time))
+        return "\n".join(lines) + "\n"
+
+
+# The bytes taken up by each command number, including the number (0 for
+# commands that cannot be decoded), and the speed factor set by commands that
+# change a player's time, None for jumps.
+_command_steps = [0] * 256
+_time_commands = {}
+for _number, _command in _command_types.items():
+    if _command is not None:
+        _command_steps[_number] = _command_struct.size + _command._data_struct.size
+        if issubclass(_command, MoveTimePosition):
+            _time_commands[_number] = None
+        elif hasattr(_command, '_speed_factor'):
+            _time_commands[_number] = _command._speed_factor
+del _number, _command
+
+
+def _advance_players(player_seat_map, timestamp, msg_type, message, seat, data,
+                     visit=None):
+    """Apply a record's effect on player_seat_map and its Players, the same as
+    _replay_messages would, but without constructing any messages.
+
+    If given, visit(command_number, player) is called for every command
+    before its effect is applied. Records that _replay_messages would fail on
+    are skipped over.
+    """
+    player = player_seat_map.get(seat)
+    if msg_type == MessageType.MESSAGE and \
+            message == MessageContentType.CHRONAL_COMMANDS:
+        if player is None or not data[0]:
+            return
+        player._update_timestamp(timestamp)
+        offset = _command_struct.size
+        for i in range(data[0]):
+            command_number = data[offset]
+            step = _command_steps[command_number]
+            if not step:
+                return
+            if visit is not None:
+                visit(command_number, player)
+            if command_number in _time_commands:
+                speed_factor = _time_commands[command_number]
+                if speed_factor is None:
+                    player.time_position, = \
+                        MoveTimePosition._data_struct.unpack_from(data,
+                                                                  offset + 1)
+                else:
+                    player._time_speed_factor = speed_factor
+            offset += step
+    elif msg_type == MessageType.NEW_CLIENT:
+        if player is None:
+            player = player_seat_map[seat] = Player(seat, str(data, 'ascii'))
+        player._update_timestamp(timestamp)
+    elif msg_type == MessageType.DISCONNECTED:
+        if player is not None:
+            player._update_timestamp(timestamp)
+            del player_seat_map[seat]
+    elif player is not None and msg_type not in (MessageType.NO_MESSAGE,
+                                                 MessageType.NEW_BANNED_CLIENT):
+        player._update_timestamp(timestamp)
+
+
+def _decode_replay_chunk(job):
+    """Decode a chunk of records for Replay.parallel_messages.
+
+    job holds the records' bytes, the (seat, state) pairs of the players in
+    the seat map before them, and the types, seats and time_range arguments.
+    Returns marshal data of the messages' rows, the Players' states at the
+    end of the chunk, the seat of each Player that was in the seat map
+    before the chunk (or -1) and the seat map after it.
+    """
+    data, player_states, types, seats, time_range = job
+    player_seat_map = dict((seat, Player._from_state(state))
+                           for seat, state in player_states)
+    initial = dict((id(player), seat)
+                   for seat, player in player_seat_map.items())
+    known_players = list(player_seat_map.values())
+
+    records, end = _complete_records(data)
+    messages = list(_replay_messages(records, player_seat_map, types, seats,
+                                     time_range))
+    del records
+    known_players.extend(player_seat_map.values())
+    class_names, players, rows = _message_rows(messages, known_players)
+    numbers = dict((id(player), number) for number, player in enumerate(players))
+    return marshal.dumps((
+        class_names, [player._get_state() for player in players],
+        [initial.get(id(player), -1) for player in players], rows,
+        [(seat, numbers[id(player)])
+         for seat, player in player_seat_map.items()]
+    ))
+
+
+def _print_record_error(timestamp, msg_type, message, player, params):
+    print("\nERROR parsing replay message:", file=sys.stderr)
+    print("Timestamp: %s" % timestamp, file=sys.stderr)
+    print("Message type: %s" % MessageType.reverse_mapping.get(msg_type, "unknown (number %d)" % msg_type), file=sys.stderr)
+    print("Message content: %s" % MessageContentType.reverse_mapping.get(message, "unknown (number %d)" % message), file=sys.stderr)
+    print("Player: %s" % player, file=sys.stderr)
+    print("Parameters: %s" % bytes(params), file=sys.stderr)
+
+
+def _replay_messages(records, player_seat_map, types=None, seats=None,
+                     time_range=None, lazy=False, stats=None, errors=None):
+    """Turn raw records into messages, see Replay.messages.
+
+    player_seat_map maps seat numbers to the Players currently in them, and is
+    updated as clients join and disconnect. stats only times decoding; to
+    time framing, pass records through its _timed_records.
+    """
+    filtered = types is not None or seats is not None or time_range is not None
+    if types is None:
+        types = BaseReplayMessage
+    start, end = (None, None) if time_range is None else time_range
+
+    for timestamp, msg_type, message, seat, params in records:
+        player = player_seat_map.get(seat, seat)
+        wanted = not (seats is not None and seat not in seats or
+                      start is not None and timestamp < start or
+                      end is not None and timestamp >= end)
+        try:
+            if stats is not None:
+                msg = stats._decode(timestamp, msg_type, message, player,
+                                    params, (types if wanted else ())
+                                    if filtered else None, lazy)
+            elif filtered:
+                msg = _filter_replay_message(timestamp, msg_type, message,
+                                             player, params,
+                                             types if wanted else (), lazy)
+            else:
+                msg = make_replay_message(timestamp, msg_type, message, player,
+                                          params, lazy)
+        except Exception as e:
+            if errors is None:
+                _print_record_error(timestamp, msg_type, message, player,
+                                    params)
+                raise
+            errors.append(RecordError('decode', "%s: %s" % (type(e).__name__,
+                                                             e),
+                                      timestamp=timestamp, msg_type=msg_type,
+                                      message=message, seat=seat,
+                                      size=len(params)))
+            msg = UnknownMessage(timestamp, msg_type, message, player, params)
+        except:
+            _print_record_error(timestamp, msg_type, message, player, params)
+            raise
+
+        if isinstance(msg, NewClientMessage):
+            player_seat_map[seat] = msg.player
+        elif isinstance(msg, DisconnectedMessage):
+            # A disconnect from an empty seat (or NONE_PLAYER) changes
+            # nothing, as in _advance_players.
+            player_seat_map.pop(seat, None)
+
+        if not wanted:
+            continue
+        if isinstance(msg, list):
+            for m in msg:
+                if isinstance(m, types):
                     yield m
+        elif isinstance(msg, types):
+            yield msg
+
+
+# The commands WindowedMetrics counts as time travel.
+_time_travel_commands = (MoveTimePosition, JumpToBookmark, UndoForUnit)
+
+
+def _event_metrics(cls):
+    """Return the indices in WindowedMetrics.METRICS of the counts a message
+    of class cls adds to."""
+    if issubclass(cls, BaseCommand):
+        return (0, 1) if issubclass(cls, _time_travel_commands) else (0,)
+    return (2,) if issubclass(cls, ChatMessage) else ()
+
+
+_command_metrics = dict((number, _event_metrics(command))
+                        for number, command in _command_types.items()
+                        if command is not None)
+
+
+class WindowedMetrics(object):
+    """Per-player rates of actions, time travel and chat over a sliding window.
+
+    process (for messages) and process_records (for raw records) yield a
+    sample (timestamp, seat, actions, time_travel, chat) for every player in
+    the game every interval ticks, and for the last timestamp of the replay.
+    actions counts the player's commands, time_travel their MoveTimePosition,
+    JumpToBookmark and UndoForUnit commands, and chat their chat messages, in
+    the last window ticks. With clock='time_position' the window is instead
+    the last window ticks of the player's own timeline, up to their current
+    time position, and every event is placed where the player was when it
+    happened. Multiply a count by GAME_TICKS_PER_SECOND * 60.0 / window for a
+    rate per minute, e.g. APM.
+
+    Counts are kept per bucket of bucket ticks in a fixed ring per player, so
+    memory does not depend on the length of the replay. Windows are rounded to
+    whole buckets, and with clock='time_position' a bucket is forgotten once
+    an event at a position a multiple of window away takes its place.
+    """
+    _fields = (
+        ('timestamp', 'L'),
+        ('seat', 'B'),
+        ('actions', 'L'),
+        ('time_travel', 'L'),
+        ('chat', 'L')
+    )
+    METRICS = tuple(name for name, typecode in _fields[2:])
+    CLOCKS = ('timestamp', 'time_position')
+
+    def __init__(self, window=GAME_TICKS_PER_SECOND * 60,
+                 bucket=GAME_TICKS_PER_SECOND, clock='timestamp',
+                 interval=None):
+        if clock not in WindowedMetrics.CLOCKS:
+            raise ValueError("clock must be one of %s"
+                             % ", ".join(WindowedMetrics.CLOCKS))
+        if bucket < 1 or window < bucket or window % bucket:
+            raise ValueError("window must be a positive multiple of bucket")
+        self.window = window
+        self.bucket = bucket
+        self.clock = clock
+        self.interval = bucket if interval is None else interval
+        self._size = window // bucket
+        self._reset()
+
+    def _reset(self):
+        self._rings = {}      # seat: (bucket numbers, counts per metric)
+        self._positions = {}  # seat: the player's current time_position
+        self._next_sample = None
+        self._timestamp = None
+
+    def _seen(self, seat, time_position):
+        if seat not in self._rings:
+            self._rings[seat] = ([None] * self._size,
+                                 [0] * (len(self.METRICS) * self._size))
+        self._positions[seat] = time_position
+
+    def _leave(self, seat):
+        self._rings.pop(seat, None)
+        self._positions.pop(seat, None)
+
+    def _count(self, seat, position, metrics):
+        numbers, counts = self._rings[seat]
+        number = position // self.bucket
+        slot = number % self._size
+        width = len(self.METRICS)
+        if numbers[slot] != number:
+            numbers[slot] = number
+            counts[slot * width:(slot + 1) * width] = [0] * width
+        for metric in metrics:
+            counts[slot * width + metric] += 1
+
+    def _samples(self, timestamp):
+        width = len(self.METRICS)
+        for seat in sorted(self._rings):
+            numbers, counts = self._rings[seat]
+            if self.clock == 'timestamp':
+                last = timestamp // self.bucket
             else:
-                yield msg
-
+                last = self._positions[seat] // self.bucket
+            totals = [0] * width
+            for slot, number in enumerate(numbers):
+                if number is not None and last - self._size < number <= last:
+                    for metric in range(width):
+                        totals[metric] += counts[slot * width + metric]
+            yield (timestamp, seat) + tuple(totals)
+
+    def _advance(self, timestamp):
+        # The samples due before an event at timestamp.
+        if self._next_sample is None:
+            self._next_sample = timestamp - timestamp % self.interval
+        while self._next_sample < timestamp:
+            for sample in self._samples(self._next_sample):
+                yield sample
+            self._next_sample += self.interval
+        self._timestamp = timestamp
+
+    def _finish(self):
+        if self._timestamp is not None:
+            for sample in self._samples(self._timestamp):
+                yield sample
+
+    def process(self, messages):
+        """Yield the samples for messages, which must be in replay order and
+        fresh from Replay.messages or ReplayStream.messages (not a list), as
+        players' time positions are read while they are consumed."""
+        self._reset()
+        metrics = {}
+        for message in messages:
+            for sample in self._advance(message.timestamp):
+                yield sample
+            cls = type(message)
+            if not cls._updates_timestamp:
+                continue
+            player = message.player
+            if not isinstance(player, Player):
+                continue
+            if isinstance(message, DisconnectedMessage):
+                self._leave(player.seat)
+                continue
+            self._seen(player.seat, player.time_position)
+            if cls not in metrics:
+                metrics[cls] = _event_metrics(cls)
+            if metrics[cls]:
+                if self.clock == 'timestamp':
+                    position = message.timestamp
+                elif isinstance(message, BaseCommand):
+                    position = message.time_position
+                else:
+                    position = player.time_position
+                self._count(player.seat, position, metrics[cls])
+        for sample in self._finish():
+            yield sample
+
+    def process_records(self, records):
+        """Yield the samples for raw records, as from Replay.raw_messages,
+        without decoding them into messages."""
+        self._reset()
+        player_seat_map = {}
+        timestamp_clock = self.clock == 'timestamp'
+
+        def visit(command_number, player):
+            self._count(player.seat,
+                        timestamp if timestamp_clock else player.time_position,
+                        _command_metrics[command_number])
+
+        for timestamp, msg_type, message, seat, data in records:
+            for sample in self._advance(timestamp):
+                yield sample
+            _advance_players(player_seat_map, timestamp, msg_type, message,
+                             seat, data, visit)
+            player = player_seat_map.get(seat)
+            if player is None:
+                self._leave(seat)
+                continue
+            self._seen(seat, player.time_position)
+            if msg_type == MessageType.MESSAGE and message in (
+                    MessageContentType.SEND_TEXT,
+                    MessageContentType.BROADCAST_TEXT):
+                self._count(seat, timestamp if timestamp_clock
+                            else player.time_position, (2,))
+        for sample in self._finish():
+            yield sample
+
+    @staticmethod
+    def arrays(samples):
+        """Collect samples into a dict of arrays keyed by the names in
+        _fields."""
+        columns = tuple(array.array(typecode)
+                        for name, typecode in WindowedMetrics._fields)
+        for sample in samples:
+            for column, value in zip(columns, sample):
+                column.append(value)
+        return dict((name, column) for (name, typecode), column
+                    in zip(WindowedMetrics._fields, columns))
+
+
+_message_attribute_names = {}
+
+
+def _attribute_names(cls):
+    """Return the names of the attributes of a message class other than
+    timestamp and player."""
+    names = _message_attribute_names.get(cls)
+    if names is None:
+        names = _message_attribute_names[cls] = tuple(
+            name for klass in reversed(cls.__mro__)
+            for name in klass.__dict__.get('__slots__', ())
+            if name not in ('timestamp', 'player', '_payload')
+        )
+    return names
+
+
+def message_to_dict(message):
+    """Return a dict of a message's type, timestamp, player and attributes,
+    with bytes given as hexadecimal strings."""
+    cls = type(message)
+    names = _attribute_names(cls)
+
+    player = getattr(message, 'player', None)
+    result = {
+        'type': cls.__name__,
+        'timestamp': message.timestamp,
+        'seat': None if player is None else player.seat,
+        'player': None if player is None else player.name
+    }
+    for name in names:
+        try:
+            value = getattr(message, name)
+        except AttributeError:
+            continue
+        result[name] = value.hex() if isinstance(value, bytes) else value
+    return result
+
+
+def _message_classes(cls=BaseReplayMessage):
+    yield cls
+    for subclass in cls.__subclasses__():
+        for klass in _message_classes(subclass):
+            yield klass
+
+
+def _message_rows(messages, players=()):
+    """Flatten messages into marshal-friendly rows.
+
+    Returns the names of the classes, the Players and a row per message of
+    its class number, timestamp, player number (-1 for None, -2 if it has no
+    player) and attributes. players are numbered first, even if no message
+    refers to them.
+    """
+    classes = {}
+    numbered = {}
+    for player in players:
+        numbered.setdefault(id(player), (len(numbered), player))
+    players = numbered
+    rows = []
+    for message in messages:
+        cls = type(message)
+        class_number = classes.setdefault(cls, len(classes))
+        try:
+            player = message.player
+        except AttributeError:
+            player_number = -2
+        else:
+            if player is None:
+                player_number = -1
+            else:
+                player_number = players.setdefault(id(player),
+                                                   (len(players), player))[0]
+        rows.append((class_number, message.timestamp, player_number) +
+                    tuple(getattr(message, name)
+                          for name in _attribute_names(cls)))
+
+    return ([cls.__name__ for cls in classes],
+            [player for number, player in sorted(players.values(),
+                                                 key=lambda item: item[0])],
+            rows)
+
+
+def _encode_messages(messages):
+    """Encode messages as compressed marshal data for ReplayCache."""
+    class_names, players, rows = _message_rows(messages)
+    return zlib.compress(marshal.dumps((
+        class_names, [player._get_state() for player in players], rows
+    )), 1)
+
+
+def _decode_messages(data):
+    """Decode messages encoded by _encode_messages."""
+    class_names, player_states, rows = marshal.loads(zlib.decompress(data))
+    return _messages_from_rows(class_names, [Player._from_state(state)
+                                             for state in player_states], rows)
+
+
+_row_builders = {}
+
+
+def _row_builder(cls):
+    """Return a function turning a row of _message_rows into a message of
+    class cls, given the list of Players the row's player refers to.
+
+    The function is generated with plain attribute assignments, which are
+    several times faster than setattr calls for each attribute.
+    """
+    build = _row_builders.get(cls)
+    if build is None:
+        lines = ["def build(row, players):",
+                 "    message = new(cls)",
+                 "    message.timestamp = row[1]",
+                 "    if row[2] != -2:",
+                 "        message.player = players[row[2]]"]
+        for i, name in enumerate(_attribute_names(cls)):
+            lines.append("    message.%s = row[%d]" % (name, i + 3))
+        lines.append("    return message")
+        namespace = {'new': object.__new__, 'cls': cls}
+        exec("\n".join(lines), namespace)
+        build = _row_builders[cls] = namespace['build']
+    return build
+
+
+def _messages_from_rows(class_names, players, rows):
+    """Turn the rows of _message_rows back into messages, given the classes'
+    names and the Players in the same order."""
+    classes_by_name = dict((cls.__name__, cls) for cls in _message_classes())
+    builders = [_row_builder(classes_by_name[name]) for name in class_names]
+    players = players + [None]
+
+    # None of the new objects can be part of a reference cycle, so spare the
+    # garbage collector from repeatedly scanning them.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [builders[row[0]](row, players) for row in rows]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+class ReplayCache(object):
+    """Content-addressed on-disk cache of decoded replays.
+
+    Entries are keyed by a hash of the replay contents and PARSER_VERSION, so
+    copies of a replay share an entry and parser changes invalidate them all.
+    To spare hashing the replay on every hit, the key is also recorded under
+    the replay's path, size and modification time; a replay rewritten without
+    changing those is not noticed.
+    Entries are written to a temporary file and renamed into place, so
+    concurrent readers never see a partial entry. Once the entries take up
+    more than max_bytes, the least recently used are removed. Entries that
+    cannot be read are treated as misses.
+    """
+    _suffix = ".replay-cache"
+    _key_suffix = ".replay-key"
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def messages(self, path):
+        """Return a list of the messages in the replay at path."""
+        version = "%d %d " % (PARSER_VERSION, marshal.version)
+        stat = os.stat(path)
+        key_path = os.path.join(self.directory, hashlib.sha256(
+            ("%s%s %d %d" % (version, os.path.abspath(path), stat.st_size,
+                             stat.st_mtime_ns)).encode('utf-8')
+        ).hexdigest() + self._key_suffix)
+        try:
+            with open(key_path, 'r') as key_file:
+                messages = self._load(os.path.join(self.directory,
+                                                   key_file.read() +
+                                                   self._suffix))
+            if messages is not None:
+                return messages
+        except (OSError, ValueError):
+            pass
+
+        with Replay(path) as replay:
+            key = hashlib.sha256(version.encode('ascii'))
+            key.update(replay._data)
+            key = key.hexdigest()
+            entry = os.path.join(self.directory, key + self._suffix)
+
+            messages = self._load(entry)
+            if messages is None:
+                messages = list(replay.messages())
+                self._store(entry, _encode_messages(messages))
+        self._store(key_path, key.encode('ascii'))
+        return messages
+
+    def _load(self, entry):
+        try:
+            with open(entry, 'rb') as entry_file:
+                messages = _decode_messages(entry_file.read())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            return None
+        try:
+            # Entries are evicted by modification time.
+            os.utime(entry)
+        except OSError:
+            pass
+        return messages
+
+    def _store(self, entry, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as entry_file:
+                entry_file.write(data)
+            os.replace(temp_path, entry)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith((self._suffix, self._key_suffix)):
+                continue
+            entry = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
+
+
+class ReplaySummary(object):
+    """A replay's header, the players who joined at its start and the
+    timestamp of its last record (None if not read), see read_summary."""
+
+    def __init__(self, path, version, map_path, random_seed, player_seats,
+                 players, duration):
+        self.path = path
+        self.version = version
+        self.map_path = map_path
+        self.random_seed = random_seed
+        self.player_seats = player_seats
+        self.players = players
+        self.duration = duration
+
+    def to_dict(self):
+        return {
+            'replay': self.path,
+            'version': list(self.version),
+            'map_path': self.map_path,
+            'random_seed': self.random_seed,
+            'player_seats': self.player_seats,
+            'players': [list(player) for player in self.players],
+            'duration': self.duration
+        }
+
+
+_summary_read_size = 1 << 16
+_record_header_struct = struct.Struct("<I3BI")
+
+
+def _plausible_header(msg_type, seat):
+    return msg_type in MessageType.reverse_mapping and \
+        (seat < 16 or seat == NONE_PLAYER)
+
+
+def _plausible_record_chain(data, offset, min_records=3):
+    """Follow records from offset in data, and return the timestamp of the
+    last one if they end exactly at the end of data and all look valid."""
+    end = len(data)
+    count = 0
+    timestamp = -1
+    while offset + _record_header_struct.size <= end:
+        previous = timestamp
+        timestamp, msg_type, message, seat, length = \
+            _record_header_struct.unpack_from(data, offset)
+        if timestamp < previous or not _plausible_header(msg_type, seat):
+            return None
+        offset += _record_header_struct.size + length
+        count += 1
+    if offset != end or count < min_records:
+        return None
+    return timestamp
+
+
+def _plausible_chain_end(data, offset, count=3, truncated=False):
+    """Follow count records that look valid from offset in data, or fewer
+    that end exactly at its end, and return the offset after them; None if
+    there are no such records. With truncated set, those fewer may also be
+    followed by a record cut off by the end of data."""
+    end = len(data)
+    for i in range(count):
+        if offset == end:
+            return end if i > 0 else None
+        if offset + _record_header_struct.size > end:
+            return end if truncated and i > 0 else None
+        timestamp, msg_type, message, seat, length = \
+            _record_header_struct.unpack_from(data, offset)
+        if not _plausible_header(msg_type, seat):
+            return None
+        offset += _record_header_struct.size + length
+        if offset > end:
+            return end if truncated and i > 0 else None
+    return offset
+
+
+def _resync_offset(data, start, timestamp, truncated=False):
+    """Return the first offset from start in data at which records look
+    valid again, or None.
+
+    Offsets within the records found there are candidates too, as these
+    may be garbage that happens to look like records; the first candidate
+    whose timestamp is not before timestamp is preferred.
+    """
+    end = len(data)
+    for candidate in range(start, end):
+        chain_end = _plausible_chain_end(data, candidate, truncated=truncated)
+        if chain_end is not None:
+            break
+    else:
+        return None
+    for other in range(candidate, chain_end):
+        if _plausible_chain_end(data, other, truncated=truncated) is not None \
+                and _record_header_struct.unpack_from(data, other)[0] >= \
+                timestamp:
+            return other
+    return candidate
+
+
+def _tolerant_records(data, offset, errors):
+    """Like Replay.raw_messages, but skip over corrupt framing, see there.
+
+    Any record whose header looks valid and whose payload fits is trusted,
+    whatever its timestamp. Timestamps only help choose where records start
+    again after corrupt bytes, compared to the lower of the last two
+    records' so that a single bad timestamp cannot throw the choice off.
+    """
+    end = len(data)
+    header_size = _record_header_struct.size
+    recent = (0, 0)
+    while offset < end:
+        if offset + header_size <= end:
+            header = _record_header_struct.unpack_from(data, offset)
+            next_offset = offset + header_size + header[4]
+            # A record is also trusted if what follows it looks valid, in
+            # which case it is only its header fields other than the length
+            # that are bad.
+            if next_offset <= end and (
+                    _plausible_header(header[1], header[3]) or
+                    _plausible_chain_end(data, next_offset) is not None):
+                recent = (recent[1], header[0])
+                yield header[:4] + (data[offset + header_size:next_offset],)
+                offset = next_offset
+                continue
+
+        resync = _resync_offset(data, offset + 1, min(recent))
+        if resync is None:
+            # Fewer than 3 good records may be left before a truncated one.
+            resync = _resync_offset(data, offset + 1, min(recent),
+                                    truncated=True)
+        if resync is None:
+            resync = end
+        description = "no valid record header"
+        if resync == end and (offset + header_size > end or
+                              _plausible_header(header[1], header[3])):
+            description = "truncated record at the end of the replay"
+        errors.append(RecordError('framing', description, offset=offset,
+                                  size=resync - offset))
+        offset = resync
+
+def _last_timestamp(replay_file, size, base_offset):
+    start = max(base_offset, size - _summary_read_size)
+    replay_file.seek(start)
+    tail = replay_file.read(size - start)
+    if start == base_offset:
+        return _plausible_record_chain(tail, 0, min_records=1)
+
+    # Record boundaries are unknown in the middle of the file, so look for
+    # the first offset from which a chain of records ends at the end of file.
+    for offset in range(len(tail) - _record_header_struct.size + 1):
+        timestamp = _plausible_record_chain(tail, offset)
+        if timestamp is not None:
+            return timestamp
+
+    # Fall back to following the record headers from the start.
+    offset = base_offset
+    timestamp = None
+    while offset + _record_header_struct.size <= size:
+        replay_file.seek(offset)
+        timestamp, msg_type, message, seat, length = \
+            _record_header_struct.unpack(replay_file.read(_record_header_struct.size))
+        offset += _record_header_struct.size + length
+    return timestamp
+
+
+def read_summary(path, duration=True):
+    """Return a ReplaySummary of the replay at path.
+
+    Only the header and the NEW_CLIENT records at the start of the replay are
+    read, plus, if duration is true, the end of the file to find the last
+    timestamp.
+    """
+    with open(path, 'rb') as replay_file:
+        size = os.fstat(replay_file.fileno()).st_size
+        data = replay_file.read(_summary_read_size)
+
+        while True:
+            try:
+                (version, map_path, random_seed, player_seats,
+                 base_offset) = Replay._read_header(data)
+                break
+            except struct.error:
+                if len(data) >= size:
+                    raise
+                data += replay_file.read(_summary_read_size)
+
+        players = []
+        offset = base_offset
+        while True:
+            header_end = offset + _record_header_struct.size
+            if header_end <= len(data):
+                timestamp, msg_type, message, seat, length = \
+                    _record_header_struct.unpack_from(data, offset)
+                if msg_type != MessageType.NEW_CLIENT:
+                    break
+                if header_end + length <= len(data):
+                    players.append((seat, str(data[header_end:header_end + length],
+                                              'ascii')))
+                    offset = header_end + length
+                    continue
+            if len(data) >= size:
+                break
+            data += replay_file.read(_summary_read_size)
+
+        last_timestamp = None
+        if duration:
+            last_timestamp = _last_timestamp(replay_file, size, base_offset)
+
+    return ReplaySummary(path, version, map_path, random_seed, player_seats,
+                         players, last_timestamp)
+
+
+def _summary_result(path, future):
+    try:
+        return path, future.result(), None
+    except Exception as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+
+def scan_replays(paths, duration=True, max_workers=8):
+    """Read summaries of many replays with read_summary.
+
+    paths may name files, directories and glob patterns like the command line
+    arguments. At most max_workers replays are read at a time. Yields a
+    (path, summary, error) tuple per replay, in order, where error describes
+    why the replay could not be read, if it couldn't.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        pending = collections.deque()
+        for path in _expand_replay_paths(paths):
+            pending.append((path, executor.submit(read_summary, path, duration)))
+            if len(pending) >= 2 * max_workers:
+                yield _summary_result(*pending.popleft())
+        while pending:
+            yield _summary_result(*pending.popleft())
+
+
+async def aopen_replay(source, executor=None):
+    """Open a Replay like Replay(source), in executor (by default the event
+    loop's), so that slow file systems do not block the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(executor, Replay,
+                                                            source)
+
+
+def _parse_replay_file(path):
+    with Replay(path) as replay:
+        return list(replay.messages())
+
+
+async def aparse_many(paths, max_workers=4, executor=None, function=None):
+    """Asynchronously parse many replays in other processes.
+
+    paths are as for scan_replays. Each replay is passed to function (by
+    default one returning a list of its messages) in executor, by default a
+    process pool of max_workers processes; function must be picklable to
+    run in a process pool. Yields a (path, result, error) tuple per replay,
+    in order, where error describes why the replay could not be parsed, if
+    it couldn't.
+
+    No more than 2 * max_workers replays are submitted ahead of the one
+    being waited for, so a slow consumer holds back parsing. Replays not yet
+    parsed are cancelled when the iteration is cancelled or closed.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    if function is None:
+        function = _parse_replay_file
+    own_executor = executor is None
+    if own_executor or isinstance(executor,
+                                  concurrent.futures.ProcessPoolExecutor):
+        if function is _parse_replay_file:
+            _require_importable("aparse_many", function)
+        else:
+            try:
+                pickle.dumps(function)
+            except Exception as e:
+                raise RuntimeError("aparse_many cannot pass function to "
+                                   "other processes: %s: %s"
+                                   % (type(e).__name__, e))
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+    pending = collections.deque()
+
+    async def result(path, future):
+        try:
+            return path, await asyncio.wrap_future(future), None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return path, None, "%s: %s" % (type(e).__name__, e)
 
-if __name__ == "__main__":
-    parser = OptionParser(usage="usage: %prog REPLAY")
     try:
-        options, (replay_path,) = parser.parse_args()
-    except ValueError:
+        for path in _expand_replay_paths(paths):
+            pending.append((path, executor.submit(function, path)))
+            if len(pending) >= 2 * max_workers:
+                yield await result(*pending.popleft())
+        while pending:
+            yield await result(*pending.popleft())
+    finally:
+        for path, future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ReplayCatalog(object):
+    """SQLite database describing many replays, for queries across them.
+
+    The database has a replays table with each replay's header, file size,
+    modification time and SHA-256, and tables of the players that joined
+    (players), of public and private chat (chat, where recipient is NULL for
+    public chat) and of the number and first timestamp of each message type
+    (message_counts, by class name), all keyed by replay_id. For example,
+    replays in which someone surrendered before minute 10:
+
+        SELECT path FROM replays JOIN message_counts ON id = replay_id
+        WHERE type = 'PlayerSurrender' AND first_timestamp < 10 * 60 * 18
+    """
+    _schema = """
+        CREATE TABLE IF NOT EXISTS replays (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            version TEXT NOT NULL,
+            map_path TEXT NOT NULL,
+            random_seed INTEGER NOT NULL,
+            duration INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS players (
+            replay_id INTEGER NOT NULL REFERENCES replays(id),
+            seat INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            joined INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chat (
+            replay_id INTEGER NOT NULL REFERENCES replays(id),
+            timestamp INTEGER NOT NULL,
+            seat INTEGER NOT NULL,
+            recipient INTEGER,
+            contents TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS message_counts (
+            replay_id INTEGER NOT NULL REFERENCES replays(id),
+            type TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            first_timestamp INTEGER NOT NULL,
+            PRIMARY KEY (replay_id, type)
+        );
+        CREATE INDEX IF NOT EXISTS replays_map_path ON replays(map_path);
+        CREATE INDEX IF NOT EXISTS players_replay_id ON players(replay_id);
+        CREATE INDEX IF NOT EXISTS players_name ON players(name);
+        CREATE INDEX IF NOT EXISTS chat_replay_id ON chat(replay_id);
+        CREATE INDEX IF NOT EXISTS message_counts_type
+            ON message_counts(type, first_timestamp);
+    """
+    _child_tables = ('players', 'chat', 'message_counts')
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(ReplayCatalog._schema)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def ingest(self, paths, batch_size=100):
+        """Add or update the replays named by paths.
+
+        paths may name files, directories and glob patterns like the command
+        line arguments. Replays whose modification time and size are unchanged
+        are skipped without being read, and ones whose contents hash is
+        unchanged are not parsed again. Changes are committed every
+        batch_size replays.
+
+        Returns a dict with the number of replays 'added', 'updated' and
+        'unchanged', and a list of (path, error) pairs as 'errors'.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        result = {'added': 0, 'updated': 0, 'unchanged': 0, 'errors': []}
+        pending = 0
+        cursor = self.connection.cursor()
+
+        for path in _expand_replay_paths(paths):
+            try:
+                outcome = self._ingest_replay(cursor, path)
+            except Exception as e:
+                result['errors'].append((path, "%s: %s" % (type(e).__name__, e)))
+                continue
+            result[outcome] += 1
+            if outcome != 'unchanged':
+                pending += 1
+            if pending >= batch_size:
+                self.connection.commit()
+                pending = 0
+
+        self.connection.commit()
+        return result
+
+    def _ingest_replay(self, cursor, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = cursor.execute("SELECT id, mtime, size, sha256 FROM replays "
+                             "WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[1] == stat.st_mtime and row[2] == stat.st_size:
+            return 'unchanged'
+
+        with Replay(path) as replay:
+            sha256 = hashlib.sha256(replay._data).hexdigest()
+            if row is not None and row[3] == sha256:
+                cursor.execute("UPDATE replays SET mtime = ?, size = ? "
+                               "WHERE id = ?", (stat.st_mtime, stat.st_size,
+                                                row[0]))
+                return 'unchanged'
+
+            players = []
+            chat = []
+            counts = {}
+            duration = None
+            for message in replay.messages():
+                duration = message.timestamp
+                name = type(message).__name__
+                if name in counts:
+                    counts[name][0] += 1
+                else:
+                    counts[name] = [1, message.timestamp]
+                if isinstance(message, NewClientMessage):
+                    players.append((message.player.seat, message.player.name,
+                                    message.timestamp))
+                elif isinstance(message, PrivateChatMessage):
+                    chat.append((message.timestamp, message.player.seat,
+                                 message.recipient[0], message.contents))
+                elif isinstance(message, PublicChatMessage):
+                    chat.append((message.timestamp, message.player.seat, None,
+                                 message.contents))
+
+            header = ('.'.join(str(number) for number in replay.version),
+                      replay.map_path, replay.random_seed, duration)
+
+        if row is None:
+            cursor.execute("INSERT INTO replays (path, mtime, size, sha256, "
+                           "version, map_path, random_seed, duration) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (path, stat.st_mtime, stat.st_size, sha256) + header)
+            replay_id = cursor.lastrowid
+            outcome = 'added'
+        else:
+            replay_id = row[0]
+            cursor.execute("UPDATE replays SET mtime = ?, size = ?, sha256 = ?, "
+                           "version = ?, map_path = ?, random_seed = ?, "
+                           "duration = ? WHERE id = ?",
+                           (stat.st_mtime, stat.st_size, sha256) + header +
+                           (replay_id,))
+            for table in ReplayCatalog._child_tables:
+                cursor.execute("DELETE FROM %s WHERE replay_id = ?" % table,
+                               (replay_id,))
+            outcome = 'updated'
+
+        cursor.executemany("INSERT INTO players VALUES (?, ?, ?, ?)",
+                           [(replay_id,) + player for player in players])
+        cursor.executemany("INSERT INTO chat VALUES (?, ?, ?, ?, ?)",
+                           [(replay_id,) + line for line in chat])
+        cursor.executemany("INSERT INTO message_counts VALUES (?, ?, ?, ?)",
+                           [(replay_id, name, count, first_timestamp)
+                            for name, (count, first_timestamp)
+                            in sorted(counts.items())])
+        return outcome
+
+
+# Columns written by export_commands, with their numpy dtypes. Fields that a
+# command does not have are -1.
+COMMAND_COLUMNS = (
+    ('timestamp', '<u4'),
+    ('seat', 'u1'),
+    ('command_type', 'u1'),
+    ('unit', '<i4'),
+    ('objective', 'i1'),
+    ('queued', 'i1'),
+    ('parameter', '<i8'),
+    ('target_time', '<i8'),
+    ('time_position', '<i8')
+)
+_command_columns_version = 1
+
+
+def _command_row(command):
+    target_time = getattr(command, 'target_time', None)
+    if target_time is None:
+        target_time = getattr(command, 'end_time', -1)
+    queued = getattr(command, 'queued', None)
+    return (command.timestamp, command.player.seat, command.command_type,
+            getattr(command, 'unit', -1), getattr(command, 'objective', -1),
+            -1 if queued is None else int(queued),
+            getattr(command, 'parameter', -1), target_time,
+            command.time_position)
+
+
+def export_commands(replay, directory, types=(AssignUnitObjective,
+                                               AssignUnitObjectiveOnly,
+                                               MarkUnit, UndoForUnit,
+                                               MoveTimePosition),
+                    chunk_size=1 << 16):
+    """Write the commands of the given types in replay to directory, as one
+    file of raw little-endian values per column of COMMAND_COLUMNS.
+
+    Rows are written chunk_size at a time, so memory use does not grow with
+    the replay. A commands.json manifest records the row count and dtypes;
+    use load_commands to read the columns back. Returns the number of rows.
+    """
+    _require_numpy("export_commands")
+    os.makedirs(directory, exist_ok=True)
+    files = [open(os.path.join(directory, name + ".bin"), 'wb')
+             for name, dtype in COMMAND_COLUMNS]
+    rows = 0
+    try:
+        chunk = []
+        for command in replay.messages(types=types):
+            chunk.append(_command_row(command))
+            if len(chunk) == chunk_size:
+                _write_command_chunk(files, chunk)
+                rows += len(chunk)
+                chunk = []
+        _write_command_chunk(files, chunk)
+        rows += len(chunk)
+    finally:
+        for column_file in files:
+            column_file.close()
+
+    with open(os.path.join(directory, "commands.json"), 'w') as manifest:
+        json.dump({
+            'version': _command_columns_version,
+            'rows': rows,
+            'columns': [list(column) for column in COMMAND_COLUMNS]
+        }, manifest)
+    return rows
+
+
+def _write_command_chunk(files, chunk):
+    for column_file, (name, dtype), values in zip(files, COMMAND_COLUMNS,
+                                                  zip(*chunk)):
+        numpy.array(values, dtype=dtype).tofile(column_file)
+
+
+def load_commands(directory):
+    """Return a dict of read-only memory-mapped numpy arrays of the columns
+    written to directory by export_commands."""
+    _require_numpy("load_commands")
+    with open(os.path.join(directory, "commands.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != _command_columns_version:
+        raise ValueError("Unsupported command export version %r"
+                         % manifest.get('version'))
+
+    columns = {}
+    for name, dtype in manifest['columns']:
+        if manifest['rows'] == 0:
+            columns[name] = numpy.empty(0, dtype=dtype)
+        else:
+            columns[name] = numpy.memmap(os.path.join(directory, name + ".bin"),
+                                         dtype=dtype, mode='r',
+                                         shape=(manifest['rows'],))
+    return columns
+
+
+def _write_summary(out, summary, output_format):
+    if output_format == 'text':
+        duration = "unknown"
+        if summary.duration is not None:
+            duration = format_timestamp(summary.duration).strip()
+        out.write("%s\t%s\t%s\t%s\n" % (summary.path, summary.map_path, duration,
+                                        ", ".join(name for seat, name
+                                                  in summary.players)))
+    elif output_format == 'jsonl':
+        out.write(json.dumps(summary.to_dict()) + "\n")
+    else:
+        csv.writer(out).writerow((summary.path, summary.map_path,
+                                  summary.random_seed, summary.duration,
+                                  ";".join(name for seat, name
+                                           in summary.players)))
+
+
+OUTPUT_FORMATS = ('text', 'jsonl', 'csv')
+_csv_columns = ('replay', 'timestamp', 'type', 'seat', 'description')
+_summary_csv_columns = ('replay', 'map_path', 'random_seed', 'duration',
+                        'players')
+
+
+# Messages rendered per write to the output.
+_render_batch_size = 4096
+
+
+def _batches(iterable, size):
+    """Yield lists of up to size items of iterable. If iterating fails, the
+    items before the failure are still yielded before the exception."""
+    iterator = iter(iterable)
+    while True:
+        batch = []
+        try:
+            for item in itertools.islice(iterator, size):
+                batch.append(item)
+        except Exception:
+            if batch:
+                yield batch
+            raise
+        if not batch:
+            return
+        yield batch
+
+
+def _render_text(path, batch, with_path):
+    prefix = "%s\t" % path if with_path else ""
+    return "".join(["%s[%s]\t%s\n" % (prefix,
+                                       format_timestamp(message.timestamp),
+                                       message)
+                    for message in batch])
+
+
+# Like json.dumps, but without checking message dicts for cycles.
+_encode_json = json.JSONEncoder(check_circular=False).encode
+
+
+def _render_jsonl(path, batch, with_path):
+    lines = []
+    for message in batch:
+        fields = message_to_dict(message)
+        fields['replay'] = path
+        lines.append(_encode_json(fields))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _render_csv(path, batch, with_path):
+    out = io.StringIO()
+    rows = []
+    for message in batch:
+        player = getattr(message, 'player', None)
+        rows.append((path, message.timestamp, type(message).__name__,
+                     '' if player is None else player.seat, message))
+    csv.writer(out).writerows(rows)
+    return out.getvalue()
+
+
+# Functions rendering a batch of messages as a string, by output format.
+_message_renderers = {
+    'text': _render_text,
+    'jsonl': _render_jsonl,
+    'csv': _render_csv
+}
+
+
+def _write_messages(out, path, messages, output_format, with_path=False):
+    """Write messages to out in output_format, a batch at a time."""
+    render = _message_renderers[output_format]
+    messages = (message for message in messages
+                if not isinstance(message, NoOpMessage))
+    for batch in _batches(messages, _render_batch_size):
+        out.write(render(path, batch, with_path))
+
+
+def _render_replay_file(job):
+    """Render one replay for the batch CLI.
+
+    Returns the path, the rendered output, None and the RecordErrors
+    recovered from if recover is set, or the path, None and an error
+    description if the replay could not be parsed.
+    """
+    path, output_format, with_path, recover = job
+    out = io.StringIO()
+    errors = [] if recover else None
+    try:
+        with _open_replay(path) as replay:
+            _write_messages(out, path, replay.messages(errors=errors),
+                            output_format, with_path)
+    except Exception as e:
+        return path, None, "%s: %s" % (type(e).__name__, e), errors
+    return path, out.getvalue(), None, errors
+
+
+def _report_record_errors(path, errors):
+    for error in errors or ():
+        sys.stderr.write("%s: %s\n" % (path, error))
+
+
+def _expand_replay_paths(args):
+    """Yield the replay files named by args, which may be files, directories
+    (searched recursively for .ach files) or glob patterns."""
+    for arg in args:
+        if os.path.isdir(arg):
+            for root, dirs, files in os.walk(arg):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.ach'):
+                        yield os.path.join(root, name)
+        elif not os.path.exists(arg) and any(c in arg for c in '*?['):
+            for match in _expand_replay_paths(sorted(glob.glob(arg,
+                                                               recursive=True))):
+                yield match
+        else:
+            yield arg
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] REPLAY...",
+                          description="Print the messages in Achron replays. "
+                          "REPLAY may be a file, a directory to search for "
+                          ".ach files, a glob pattern or - for standard "
+                          "input.")
+    parser.add_option("-f", "--format", choices=OUTPUT_FORMATS, default='text',
+                      help="output format: text, jsonl or csv "
+                      "(default: %default)")
+    parser.add_option("-j", "--jobs", type='int', default=1,
+                      help="number of replays parsed at a time by separate "
+                      "processes, or read at a time with --summary; a single "
+                      "replay is always parsed in this process "
+                      "(default: %default)")
+    parser.add_option("--unordered", action='store_true', default=False,
+                      help="print each replay as soon as it has been parsed "
+                      "instead of in the order given")
+    parser.add_option("--summary", action='store_true', default=False,
+                      help="only print each replay's map, duration and "
+                      "players, read without parsing the whole replay")
+    parser.add_option("--stats", action='store_true', default=False,
+                      help="instead of the messages, print the count, size "
+                      "and decoding time of each kind of message, as JSON "
+                      "with -f jsonl and as a table otherwise; replays are "
+                      "parsed one at a time")
+    parser.add_option("--recover", action='store_true', default=False,
+                      help="print records that cannot be decoded as unknown "
+                      "messages and skip corrupt data, reporting both on "
+                      "standard error, instead of giving up on the replay")
+    options, args = parser.parse_args()
+    if not args:
         parser.error("Path to replay is required.")
 
-    with open(replay_path, 'rb') as replay_file:
-        for message in Replay(replay_file.read()).messages():
-            if not isinstance(message, NoOpMessage):
-                print("[%s]\t%s" % (format_timestamp(message.timestamp), message))
+    if options.summary:
+        if options.format == 'csv':
+            csv.writer(sys.stdout).writerow(_summary_csv_columns)
+        failures = 0
+        for path, summary, error in scan_replays(args,
+                                                 max_workers=options.jobs):
+            if error is None:
+                _write_summary(sys.stdout, summary, options.format)
+            else:
+                failures += 1
+                sys.stderr.write("%s: %s\n" % (path, error))
+        return 1 if failures else 0
+
+    paths = list(_expand_replay_paths(args))
+    with_path = len(paths) > 1
+
+    if options.stats:
+        stats = ParseStats()
+        failures = 0
+        for path in paths:
+            try:
+                with _open_replay(path) as replay:
+                    for message in replay.messages(stats=stats):
+                        pass
+            except Exception as e:
+                failures += 1
+                sys.stderr.write("%s: %s: %s\n" % (path, type(e).__name__, e))
+        if options.format == 'jsonl':
+            sys.stdout.write(json.dumps(stats.to_dict()) + "\n")
+        else:
+            sys.stdout.write(stats.format_table())
+        return 1 if failures else 0
+    if options.format == 'csv':
+        csv.writer(sys.stdout).writerow(_csv_columns)
+
+    failures = 0
+    if options.jobs > 1 and len(paths) > 1 and '-' not in paths:
+        jobs = [(path, options.format, with_path, options.recover)
+                for path in paths]
+        with multiprocessing.Pool(options.jobs) as pool:
+            if options.unordered:
+                results = pool.imap_unordered(_render_replay_file, jobs)
+            else:
+                results = pool.imap(_render_replay_file, jobs)
+            for path, output, error, errors in results:
+                _report_record_errors(path, errors)
+                if error is None:
+                    sys.stdout.write(output)
+                else:
+                    failures += 1
+                    sys.stderr.write("%s: %s\n" % (path, error))
+    else:
+        for path in paths:
+            errors = [] if options.recover else None
+            try:
+                with _open_replay(path) as replay:
+                    _write_messages(sys.stdout, path,
+                                    replay.messages(errors=errors),
+                                    options.format, with_path)
+            except BrokenPipeError:
+                raise
+            except Exception as e:
+                failures += 1
+                sys.stderr.write("%s: %s: %s\n" % (path, type(e).__name__, e))
+            finally:
+                _report_record_errors(path, errors)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
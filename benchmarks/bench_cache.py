@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Benchmark ReplayCache hits against parsing a replay from scratch."""
+
+import os
+import shutil
+import tempfile
+import time
+
+from common import load_parser, synthetic_replay
+
+arp = load_parser()
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        print("%8s %10s %10s %10s %8s" % ("records", "parse (s)", "miss (s)",
+                                          "hit (s)", "speedup"))
+        for record_count in (1000, 10000, 100000):
+            path = os.path.join(directory, "%d.ach" % record_count)
+            with open(path, 'wb') as replay_file:
+                replay_file.write(synthetic_replay(arp, record_count))
+            cache = arp.ReplayCache(os.path.join(directory, "cache"))
+
+            def parse():
+                with arp.Replay(path) as replay:
+                    return list(replay.messages())
+
+            messages, parse_time = timed(parse)
+            missed, miss_time = timed(lambda: cache.messages(path))
+            hit, hit_time = timed(lambda: cache.messages(path))
+            assert len(messages) == len(missed) == len(hit)
+            print("%8d %10.3f %10.3f %10.3f %7.1fx" % (
+                record_count, parse_time, miss_time, hit_time,
+                parse_time / hit_time))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Microbenchmark for decoding CHRONAL_COMMANDS batches with make_command.
+
+Compares the offset-based decoder against the previous implementation, which
+re-sliced the remaining buffer and rebuilt its dispatch table for every
+command.
+"""
+
+import struct
+import timeit
+
+from common import load_parser
+
+arp = load_parser()
+
+
+def legacy_make_command(timestamp, message, player, data):
+    CommandType = arp.CommandType
+    command_count, = arp._command_struct.unpack_from(data)
+    data = data[arp._command_struct.size:]
+    results = []
+
+    for i in range(command_count):
+        command_number, = arp._command_struct.unpack_from(data)
+        data = data[arp._command_struct.size:]
+
+        command = {
+            CommandType.MOVE_TIME_POSITION: arp.MoveTimePosition,
+            CommandType.FOLLOW_TO_TIME: arp.MoveTimePosition,
+            CommandType.ASSIGN_UNIT_OBJECTIVE: arp.AssignUnitObjective,
+            CommandType.ASSIGN_UNIT_OBJECTIVE_ONLY: arp.AssignUnitObjectiveOnly,
+            CommandType.MARK_UNIT: arp.MarkUnit,
+            CommandType.DELETE_EVENTS: arp.UndoForUnit,
+            CommandType.SET_BOOKMARK: arp.SetBookmark,
+            CommandType.JUMP_TO_BOOKMARK: arp.JumpToBookmark,
+            CommandType.CREATE_ALLIANCE: arp.CreateAlliance,
+            CommandType.BREAK_ALLIANCE: arp.BreakAlliance,
+            CommandType.GIVE_COMMAND_ABILITY_TO_PLAYER: arp.ShareControl,
+            CommandType.REVOKE_COMMAND_ABILITY_FROM_PLAYER: arp.RevokeControl,
+            CommandType.FAST_TIME: arp.SwitchFastForward,
+            CommandType.SLOW_TIME: arp.SwitchSlowMotion,
+            CommandType.STOP_TIME: arp.SwitchPause,
+            CommandType.NORMAL_TIME: arp.SwitchNormalTime,
+            CommandType.DEBUG_RELOAD_SCRIPTS: arp.ReloadScripts,
+            CommandType.DELETE_NEXT_COMMAND_AND_JUMP_TO_TIME: None,
+        }[command_number]
+
+        results.append(command(timestamp, message, player, data))
+        data = data[command._data_struct.size:]
+
+    return results
+
+
+def command_batch(count):
+    command = struct.pack("<BHBI", arp.CommandType.ASSIGN_UNIT_OBJECTIVE,
+                          1234, 2, 5678)
+    return struct.pack("<B", count) + command * count
+
+
+def main():
+    player = arp.Player(0, "bench")
+    message = arp.MessageContentType.CHRONAL_COMMANDS
+
+    print("%8s %14s %14s %8s" % ("commands", "legacy (us)", "offset (us)",
+                                 "speedup"))
+    for count in (1, 16, 64, 255):
+        data = command_batch(count)
+        number = max(20000 // count, 50)
+        legacy = min(timeit.repeat(
+            lambda: legacy_make_command(0, message, player, data),
+            number=number, repeat=5)) / number
+        current = min(timeit.repeat(
+            lambda: arp.make_command(0, message, player, data),
+            number=number, repeat=5)) / number
+        print("%8d %14.2f %14.2f %7.2fx" % (count, legacy * 1e6,
+                                            current * 1e6, legacy / current))
+
+
+if __name__ == "__main__":
+    main()
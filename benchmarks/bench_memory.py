@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Memory benchmark for keeping a whole replay's messages in memory.
+
+Compares the __slots__-based message classes against equivalent objects with a
+per-instance __dict__, which is how the message classes used to be stored.
+"""
+
+import tracemalloc
+
+from common import load_parser, synthetic_replay
+
+arp = load_parser()
+
+
+class DictMessage(object):
+    """Stand-in for a message class without __slots__."""
+
+
+def slot_names(cls):
+    for klass in cls.__mro__:
+        for name in getattr(klass, '__slots__', ()):
+            if name != '_payload':
+                yield name
+
+
+def as_dict_message(message):
+    copy = DictMessage()
+    for name in slot_names(type(message)):
+        try:
+            setattr(copy, name, getattr(message, name))
+        except AttributeError:
+            pass
+    return copy
+
+
+def traced_size(build):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    print("%8s %10s %14s %14s %8s" % ("records", "messages", "slots (B/msg)",
+                                      "dict (B/msg)", "saving"))
+    for record_count in (1000, 10000, 100000):
+        replay = arp.Replay(synthetic_replay(arp, record_count))
+        messages, slots_size = traced_size(lambda: list(replay.messages()))
+        # Copy freshly parsed messages, so both sizes include the attribute
+        # values the messages refer to.
+        copies, dict_size = traced_size(
+            lambda: [as_dict_message(m) for m in replay.messages()])
+        print("%8d %10d %14.1f %14.1f %7.1f%%" % (
+            record_count, len(messages), slots_size / float(len(messages)),
+            dict_size / float(len(copies)),
+            100.0 * (1 - slots_size / float(dict_size))))
+
+
+if __name__ == "__main__":
+    main()
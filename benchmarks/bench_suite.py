@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Throughput, memory and per-phase timings of the parser on generated replays.
+
+Every replay is first round-tripped: its raw records are written back out with
+ReplayWriter and must reproduce the generated bytes exactly. Then, for each
+phase, the best of several runs is reported:
+
+  raw_messages  splitting the replay into records
+  make_command  decoding the payloads of all CHRONAL_COMMANDS records
+  messages      Replay.messages(), i.e. decoding everything
+
+Peak memory is that of building a list of all messages, traced separately
+since tracemalloc slows everything else down.
+
+Usage: bench_suite.py [RECORDS...]
+"""
+
+import io
+import sys
+import time
+import tracemalloc
+
+from common import load_parser, synthetic_replay
+
+arp = load_parser()
+
+REPEATS = 3
+
+
+def round_trip(data):
+    with arp.Replay(data) as replay:
+        output = io.BytesIO()
+        writer = arp.ReplayWriter(output, replay.map_path, replay.random_seed,
+                                  replay.player_seats, replay.version)
+        for record in replay.raw_messages():
+            writer.write_record(*record)
+        assert output.getvalue() == data, "ReplayWriter output differs"
+
+
+def best_time(function):
+    best = None
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        count = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, best
+
+
+def phases(replay):
+    def raw_messages():
+        return sum(1 for record in replay.raw_messages())
+
+    chronal = [record for record in replay.raw_messages()
+               if record[1] == arp.MessageType.MESSAGE and
+               record[2] == arp.MessageContentType.CHRONAL_COMMANDS]
+    players = dict((seat, arp.Player(seat, "player%d" % seat))
+                   for seat in set(record[3] for record in chronal))
+
+    def make_command():
+        count = 0
+        for timestamp, msg_type, message, seat, params in chronal:
+            count += len(arp.make_command(timestamp, message, players[seat],
+                                          params))
+        return count
+
+    def messages():
+        return sum(1 for message in replay.messages())
+
+    return (("raw_messages", raw_messages), ("make_command", make_command),
+            ("messages", messages))
+
+
+def peak_memory(replay):
+    tracemalloc.start()
+    try:
+        messages = list(replay.messages())
+        peak = tracemalloc.get_traced_memory()[1]
+        del messages
+        return peak
+    finally:
+        tracemalloc.stop()
+
+
+def main(record_counts):
+    print("%8s %8s %-14s %9s %8s %12s %9s" % (
+        "records", "MB", "phase", "time (s)", "MB/s", "items/s", "peak MB"))
+    for record_count in record_counts:
+        data = synthetic_replay(arp, record_count, switch_rate=0.05,
+                                churn_rate=0.001)
+        round_trip(data)
+        megabytes = len(data) / 1e6
+        with arp.Replay(data) as replay:
+            for name, function in phases(replay):
+                count, elapsed = best_time(function)
+                print("%8d %8.1f %-14s %9.3f %8.1f %12.0f %9s" % (
+                    record_count, megabytes, name, elapsed,
+                    megabytes / elapsed, count / elapsed, ""))
+            print("%8d %8.1f %-14s %9s %8s %12s %9.1f" % (
+                record_count, megabytes, "list(messages)", "", "", "",
+                peak_memory(replay) / 1e6))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 300000])
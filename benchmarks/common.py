@@ -0,0 +1,83 @@
+"""Helpers shared by the benchmark scripts."""
+
+import importlib.util
+import io
+import os
+import random
+import sys
+
+PARSER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "achron-replay-parser.py")
+
+
+def load_parser():
+    """Import achron-replay-parser.py, whose name is not a valid module name.
+
+    The module is registered in sys.modules as achron_replay_parser before
+    it runs, like a regular import, so that its functions can be pickled for
+    the worker processes of Replay.parallel_messages and aparse_many. Load
+    it the same way when using the parser as a library.
+    """
+    spec = importlib.util.spec_from_file_location("achron_replay_parser",
+                                                  PARSER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[spec.name]
+        raise
+    return module
+
+
+def synthetic_replay(arp, record_count, seed=0, players=4, max_commands=12,
+                     switch_rate=0.0, churn_rate=0.0):
+    """Return the bytes of a command-heavy replay with some chat mixed in.
+
+    Each CHRONAL_COMMANDS record carries 1 to max_commands commands. A
+    switch_rate fraction of them also switch the player's time speed or jump
+    in time, and a churn_rate fraction of records are replaced by a player
+    disconnecting and rejoining. The same arguments always give the same
+    replay.
+    """
+    rng = random.Random(seed)
+    output = io.BytesIO()
+    writer = arp.ReplayWriter(output, "maps/benchmark.map", seed,
+                              [True] * players)
+    for seat in range(players):
+        writer.write_join(0, seat, "player%d" % seat)
+
+    CommandType = arp.CommandType
+    switches = (CommandType.FAST_TIME, CommandType.SLOW_TIME,
+                CommandType.STOP_TIME, CommandType.NORMAL_TIME)
+    timestamp = 0
+    for i in range(record_count):
+        timestamp += rng.randint(0, 8)
+        seat = rng.randrange(players)
+        if churn_rate and rng.random() < churn_rate:
+            writer.write_disconnect(timestamp, seat)
+            writer.write_join(timestamp, seat, "player%d" % seat)
+            continue
+        if rng.random() < 0.1:
+            if rng.random() < 0.2:
+                writer.write_chat(timestamp, seat, "whisper number %d" % i,
+                                  rng.randrange(players))
+            else:
+                writer.write_chat(timestamp, seat, "message number %d" % i)
+            continue
+        commands = []
+        for j in range(rng.randint(1, max_commands)):
+            commands.append((CommandType.ASSIGN_UNIT_OBJECTIVE,
+                             rng.randrange(4096), rng.randrange(12),
+                             rng.randrange(1 << 20)))
+        if rng.random() < 0.2:
+            commands.append((CommandType.DELETE_EVENTS, rng.randrange(4096),
+                             timestamp))
+        if switch_rate and rng.random() < switch_rate:
+            if rng.random() < 0.5:
+                commands.append((rng.choice(switches),))
+            else:
+                commands.append((CommandType.MOVE_TIME_POSITION,
+                                 rng.randrange(timestamp // 2 + 1)))
+        writer.write_commands(timestamp, seat, commands)
+    return output.getvalue()